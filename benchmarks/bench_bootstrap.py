@@ -0,0 +1,88 @@
+"""Compares bootstrapping pipsi with get-pipsi.py from a zipapp against
+the virtualenv and pip based flow, and how long `pipsi list` takes to
+start with either.
+
+    python benchmarks/bench_bootstrap.py [--runs N] [-o results.json]
+
+The virtualenv flow installs pipsi and its dependencies through pip and
+needs access to a package index.  If that fails it is reported as not ok.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed_call(args):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        rv = subprocess.call(args, stdout=devnull, stderr=devnull)
+    return time.time() - start, rv == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Invocations of pipsi list per flow.')
+    parser.add_argument('--output', '-o', default='-',
+                        help='Where to write the JSON results to.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='pipsi-bench-')
+    results = []
+    try:
+        for name, compile_ in (('zipapp', False), ('zipapp-compiled', True)):
+            subprocess.check_call(
+                [sys.executable, os.path.join(HERE, 'build-zipapp.py'),
+                 '-o', os.path.join(root, name + '.pyz')] +
+                (['--compile'] if compile_ else []),
+                stdout=subprocess.PIPE)
+
+        flows = [(name, ['--zipapp', os.path.join(root, name + '.pyz')])
+                 for name in ('zipapp', 'zipapp-compiled')]
+        flows.append(('virtualenv', ['--src', HERE]))
+        for name, flow_args in flows:
+            bin_dir = os.path.join(root, name, 'bin')
+            home = os.path.join(root, name, 'venvs')
+            seconds, ok = timed_call([
+                sys.executable, os.path.join(HERE, 'get-pipsi.py'),
+                '--bin-dir', bin_dir, '--home', home, '--ignore-existing',
+                '--no-modify-path'] + flow_args)
+            results.append({'benchmark': 'bootstrap', 'flow': name,
+                            'seconds': round(seconds, 6), 'ok': ok})
+            if not ok:
+                continue
+
+            pipsi = os.path.join(bin_dir, os.listdir(bin_dir)[0])
+            timings = [timed_call([pipsi, '--home', home, 'list'])[0]
+                       for _ in range(args.runs)]
+            results.append({'benchmark': 'startup', 'flow': name,
+                            'runs': args.runs,
+                            'min': round(min(timings), 6),
+                            'avg': round(sum(timings) / len(timings), 6)})
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
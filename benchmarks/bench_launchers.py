@@ -0,0 +1,115 @@
+"""Compares how long it takes to start a tool through the script pip
+generated, through a pipsi launcher and through a ``pkg_resources`` based
+wrapper like the ones of legacy setuptools installs.
+
+    python benchmarks/bench_launchers.py [--runs N] [-o results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_repo import PACKAGE, make_wheel, quiet
+from pipsi import Repo, BIN_DIR
+
+LEGACY_WRAPPER = '''\
+#!%(python)s
+# EASY-INSTALL-ENTRY-SCRIPT: '%(dist)s','console_scripts','%(name)s'
+__requires__ = '%(dist)s'
+import re
+import sys
+from pkg_resources import load_entry_point
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw?|\\.exe)?$', '', sys.argv[0])
+    sys.exit(
+        load_entry_point('%(dist)s', 'console_scripts', '%(name)s')()
+    )
+'''
+
+
+def timed_runs(script, runs):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call([script], stdout=devnull)
+            timings.append(time.time() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Invocations of every script.')
+    parser.add_argument('--output', '-o', default='-',
+                        help='Where to write the JSON results to.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='pipsi-bench-')
+    old_environ = dict(os.environ)
+    scripts = {}
+    try:
+        index = os.path.join(root, 'index')
+        os.makedirs(index)
+        make_wheel(index, PACKAGE, '1.0', scripts=1)
+        os.environ.update(PIP_NO_INDEX='1', PIP_FIND_LINKS=index,
+                          PIP_DISABLE_PIP_VERSION_CHECK='1')
+
+        for name, launchers in (('linked', False), ('launcher', True)):
+            repo = Repo(os.path.join(root, name),
+                        os.path.join(root, name + '-bin'),
+                        use_launchers=launchers)
+            with quiet():
+                repo.install(PACKAGE)
+            scripts[name] = os.path.join(repo.bin_dir, PACKAGE + '-0')
+
+        venv = os.path.join(root, 'linked', PACKAGE)
+        python = os.path.join(venv, BIN_DIR, 'python')
+        with open(os.devnull, 'w') as devnull:
+            has_pkg_resources = subprocess.call(
+                [python, '-c', 'import pkg_resources'], stderr=devnull) == 0
+        if has_pkg_resources:
+            legacy = os.path.join(root, 'legacy')
+            with open(legacy, 'w') as fh:
+                fh.write(LEGACY_WRAPPER % {
+                    'python': python, 'dist': PACKAGE + '==1.0',
+                    'name': PACKAGE + '-0'})
+            os.chmod(legacy, 0o755)
+            scripts['legacy'] = legacy
+
+        results = []
+        for name, script in sorted(scripts.items()):
+            timings = timed_runs(script, args.runs)
+            results.append({
+                'script': name,
+                'runs': args.runs,
+                'min': round(min(timings), 6),
+                'avg': round(sum(timings) / len(timings), 6),
+            })
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Times install, upgrade, list, find_scripts and uninstall against homes
+of different sizes without touching the network.
+
+Synthetic packages with many console scripts, many modules (and thus a
+long RECORD) and many dependencies are written as wheels into a local
+folder which pip uses as its only package index.  Homes are padded with
+fake virtualenvs to the requested sizes.  The results are written as JSON
+so that runs can be compared.
+
+    python benchmarks/bench_repo.py [--sizes 10,100,1000] [-o results.json]
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+
+import pipsi
+from pipsi import Repo, BIN_DIR, IS_WIN, find_scripts
+
+PACKAGE = 'pipsibench'
+
+
+def make_wheel(directory, name, version, modules=0, scripts=0, requires=()):
+    """Writes a pure Python wheel and returns its path."""
+    dist_info = '%s-%s.dist-info' % (name, version)
+    files = [('%s/__init__.py' % name, 'def main():\n    return 0\n')]
+    for i in range(modules):
+        files.append(('%s/sub%d/mod%d.py' % (name, i % 10, i),
+                      'VALUE = %d\n' % i))
+    files.append((dist_info + '/METADATA', ''.join(
+        ['Metadata-Version: 2.1\n', 'Name: %s\n' % name,
+         'Version: %s\n' % version] +
+        ['Requires-Dist: %s\n' % req for req in requires])))
+    files.append((dist_info + '/WHEEL', 'Wheel-Version: 1.0\n'
+                  'Generator: pipsi-bench\nRoot-Is-Purelib: true\n'
+                  'Tag: py2.py3-none-any\n'))
+    files.append((dist_info + '/entry_points.txt', ''.join(
+        ['[console_scripts]\n'] +
+        ['%s-%d = %s:main\n' % (name, i, name) for i in range(scripts)])))
+
+    record = []
+    filename = os.path.join(directory, '%s-%s-py2.py3-none-any.whl' % (
+        name, version))
+    with zipfile.ZipFile(filename, 'w') as zf:
+        for path, content in files:
+            data = content.encode('utf-8')
+            digest = base64.urlsafe_b64encode(
+                hashlib.sha256(data).digest()).rstrip(b'=').decode('ascii')
+            record.append('%s,sha256=%s,%d\n' % (path, digest, len(data)))
+            zf.writestr(path, data)
+        record.append('%s/RECORD,,\n' % dist_info)
+        zf.writestr(dist_info + '/RECORD', ''.join(record))
+    return filename
+
+
+def make_index(directory, scripts, modules, deps):
+    requires = ['%sdep%d' % (PACKAGE, i) for i in range(deps)]
+    for req in requires:
+        make_wheel(directory, req, '1.0', modules=modules // 10)
+    for version in ('1.0', '1.1'):
+        make_wheel(directory, PACKAGE, version, modules, scripts, requires)
+
+
+def make_fake_venv(home, name, scripts=3):
+    """Creates a virtualenv as far as listing is concerned."""
+    venv = os.path.join(home, name)
+    os.makedirs(os.path.join(venv, BIN_DIR))
+    open(os.path.join(venv, BIN_DIR,
+                      'python.exe' if IS_WIN else 'python'), 'w').close()
+    with open(os.path.join(venv, 'package_info.json'), 'w') as fh:
+        json.dump({'name': name, 'version': '1.0', 'scripts': [
+            '/nonexistent/%s-%d' % (name, i) for i in range(scripts)]}, fh)
+
+
+@contextmanager
+def quiet():
+    """Collects all output of pipsi and pip instead of printing it."""
+    pipsi._output.buffer = []
+    try:
+        yield
+    finally:
+        pipsi._output.buffer = None
+
+
+def timed(func, repeat=1):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        with quiet():
+            rv = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rv
+
+
+def bench_home(root, size, repeat):
+    home = os.path.join(root, 'home-%d' % size)
+    bin_dir = os.path.join(root, 'bin-%d' % size)
+    repo = Repo(home, bin_dir)
+    for i in range(size):
+        make_fake_venv(home, 'fake%d' % i)
+
+    results = []
+
+    def record(name, seconds, ok=True):
+        results.append({'benchmark': name, 'home_size': size,
+                        'seconds': round(seconds, 6), 'ok': bool(ok)})
+
+    def list_without_index():
+        if os.path.exists(repo.index_path):
+            os.remove(repo.index_path)
+        return repo.list_everything()
+
+    record('list_everything_scan', *timed(list_without_index, repeat))
+    record('list_everything', *timed(repo.list_everything, repeat))
+
+    # Creating the template virtualenv is a one time cost
+    timed(lambda: repo.create_virtualenv(
+        os.path.join(root, 'warmup'), sys.executable,
+        tuple(repo.pythons.probe(sys.executable)['version'])))
+    shutil.rmtree(os.path.join(root, 'warmup'))
+
+    record('install', *timed(lambda: repo.install(PACKAGE + '==1.0')))
+    venv_path = repo.get_package_path(PACKAGE)
+    record('find_scripts', *timed(
+        lambda: bool(find_scripts(venv_path, PACKAGE)), repeat))
+    record('upgrade', *timed(lambda: repo.upgrade(PACKAGE)))
+    record('upgrade_noop', *timed(lambda: repo.upgrade(PACKAGE)))
+    record('uninstall', *timed(
+        lambda: repo.uninstall(PACKAGE).perform() or True))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='Comma separated numbers of virtualenvs.')
+    parser.add_argument('--scripts', type=int, default=50,
+                        help='Console scripts of the benchmark package.')
+    parser.add_argument('--modules', type=int, default=2000,
+                        help='Modules of the benchmark package.')
+    parser.add_argument('--deps', type=int, default=20,
+                        help='Dependencies of the benchmark package.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Repetitions of the cheap benchmarks.')
+    parser.add_argument('--output', '-o', default='-',
+                        help='Where to write the JSON results to.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='pipsi-bench-')
+    old_environ = dict(os.environ)
+    try:
+        index = os.path.join(root, 'index')
+        os.makedirs(index)
+        make_index(index, args.scripts, args.modules, args.deps)
+        os.environ.update(PIP_NO_INDEX='1', PIP_FIND_LINKS=index,
+                          PIP_DISABLE_PIP_VERSION_CHECK='1')
+
+        results = []
+        for size in [int(x) for x in args.sizes.split(',')]:
+            results.extend(bench_home(root, size, args.repeat))
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'parameters': {'scripts': args.scripts, 'modules': args.modules,
+                       'deps': args.deps, 'repeat': args.repeat},
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
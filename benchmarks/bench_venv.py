@@ -0,0 +1,57 @@
+"""Compares creating virtualenvs from scratch with cloning them from a
+template virtualenv.
+
+    python benchmarks/bench_venv.py [--rounds N] [--python PYTHON]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pipsi import Repo, get_python_semver
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--python', default=sys.executable)
+    args = parser.parse_args()
+
+    semver = get_python_semver(args.python)
+    if semver[0] != 3:
+        parser.error('templates are only used for Python 3 interpreters')
+
+    home = tempfile.mkdtemp(prefix='pipsi-bench-')
+    try:
+        cold = Repo(home, os.path.join(home, 'bin'), use_templates=False)
+        cloned = Repo(home, os.path.join(home, 'bin'), use_templates=True)
+        template = timed(cloned.create_virtualenv,
+                         os.path.join(home, 'warmup'), args.python, semver)
+
+        results = {'cold': [], 'cloned': []}
+        for i in range(args.rounds):
+            for name, repo in (('cold', cold), ('cloned', cloned)):
+                venv_path = os.path.join(home, '%s-%d' % (name, i))
+                results[name].append(timed(
+                    repo.create_virtualenv, venv_path, args.python, semver))
+                shutil.rmtree(venv_path)
+    finally:
+        shutil.rmtree(home)
+
+    print('python %s, %d rounds' % ('.'.join(map(str, semver)), args.rounds))
+    print('  first install (creates template): %7.3fs' % template)
+    for name, timings in sorted(results.items()):
+        print('  %-6s min %7.3fs  avg %7.3fs' % (
+            name, min(timings), sum(timings) / len(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Builds pipsi as a single file zipapp with click (and packaging, if it
+is installed) vendored.  The result runs with any Python 3 interpreter:
+
+    python3 build-zipapp.py -o pipsi.pyz
+    python3 pipsi.pyz --help
+
+It can be installed with ``python get-pipsi.py --zipapp pipsi.pyz``.
+"""
+import argparse
+import os
+import py_compile
+import re
+import shutil
+import sys
+import tempfile
+import zipapp
+
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    metadata = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MAIN = '''\
+from pipsi import cli
+cli(prog_name='pipsi')
+'''
+
+
+def copy_package(name, target):
+    """Copies the sources of an importable package and the metadata of
+    its distribution (which includes its license) to `target`.
+    """
+    module = __import__(name)
+    source = os.path.dirname(module.__file__)
+    shutil.copytree(source, os.path.join(target, name),
+                    ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+    if metadata is None:
+        return
+    try:
+        dist = metadata.distribution(name)
+    except metadata.PackageNotFoundError:
+        return
+    for path in dist.files or ():
+        if path.parts[0].endswith('.dist-info') and \
+           path.name not in ('RECORD', 'INSTALLER', 'REQUESTED'):
+            filename = os.path.join(target, *path.parts)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            shutil.copy(str(path.locate()), filename)
+
+
+def write_pipsi_metadata(target):
+    """Writes the metadata click's ``--version`` looks up."""
+    with open(os.path.join(HERE, 'setup.py')) as fh:
+        version = re.search(r'''version=['"]([^'"]+)['"]''', fh.read()).group(1)
+    dist_info = os.path.join(target, 'pipsi-%s.dist-info' % version)
+    os.makedirs(dist_info)
+    with open(os.path.join(dist_info, 'METADATA'), 'w') as fh:
+        fh.write('Metadata-Version: 2.1\nName: pipsi\nVersion: %s\n' % version)
+
+
+def compile_sources(target):
+    """Adds bytecode next to the sources.  zipimport cannot write bytecode
+    itself and skips it for other interpreter versions.
+    """
+    for dirpath, dirnames, filenames in os.walk(target):
+        for name in filenames:
+            if name.endswith('.py'):
+                source = os.path.join(dirpath, name)
+                py_compile.compile(
+                    source, cfile=source + 'c', doraise=True,
+                    invalidation_mode=py_compile.PycInvalidationMode
+                    .CHECKED_HASH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', '-o', default='pipsi.pyz',
+                        help='Where to write the zipapp to.')
+    parser.add_argument('--python', default='/usr/bin/env python3',
+                        help='The interpreter for the shebang line.')
+    parser.add_argument('--compile', action='store_true',
+                        help='Include bytecode for the running interpreter '
+                             'to speed up starting with it.')
+    args = parser.parse_args()
+
+    sys.path.insert(0, HERE)
+    build = tempfile.mkdtemp(prefix='pipsi-zipapp-')
+    try:
+        shutil.copytree(os.path.join(HERE, 'pipsi'),
+                        os.path.join(build, 'pipsi'),
+                        ignore=shutil.ignore_patterns('__pycache__', '*.pyc',
+                                                      '__main__.py'))
+        write_pipsi_metadata(build)
+        copy_package('click', build)
+        try:
+            copy_package('packaging', build)
+        except ImportError:
+            print('packaging is not installed, upgrade checks will use '
+                  'pkg_resources if available', file=sys.stderr)
+        with open(os.path.join(build, '__main__.py'), 'w') as fh:
+            fh.write(MAIN)
+        if args.compile:
+            compile_sources(build)
+        zipapp.create_archive(build, args.output, interpreter=args.python,
+                              compressed=True)
+    finally:
+        shutil.rmtree(build)
+    print('Built %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -68,6 +68,17 @@ def publish_script(venv, bin_dir):
     echo('Installed pipsi binary in ' + bin_dir)
 
 
+def install_zipapp(zipapp, bin_dir):
+    try:
+        os.makedirs(bin_dir)
+    except OSError:
+        pass
+    target = os.path.join(bin_dir, 'pipsi.pyz' if IS_WIN else 'pipsi')
+    shutil.copyfile(zipapp, target)
+    os.chmod(target, 0o755)
+    echo('Installed pipsi zipapp in ' + bin_dir)
+
+
 def install_files(venv, bin_dir, install):
     try:
         os.makedirs(bin_dir)
@@ -131,6 +142,14 @@ def parse_options(argv):
             'Default: %(default)s'
         ),
     )
+    parser.add_argument(
+        '--zipapp',
+        help=(
+            'Install pipsi by copying a zipapp built with build-zipapp.py '
+            'into the bin folder instead of creating a virtualenv and '
+            'installing it through pip.'
+        ),
+    )
     parser.add_argument(
         '--no-modify-path',
         action='store_true',
@@ -224,6 +243,10 @@ def main(argv=sys.argv[1:]):
         succeed('pipsi is now installed')
 
     echo('Installing pipsi')
+    if args.zipapp:
+        install_zipapp(args.zipapp, args.bin_dir)
+        ensure_pipsi_on_path(args.bin_dir, not args.no_modify_path)
+        succeed('pipsi is now installed.')
     if venv_pkg is None:
         fail('You need to have virtualenv installed to bootstrap pipsi.')
 
@@ -1,32 +1,112 @@
 from __future__ import print_function
+# Only cheap modules are imported here, everything else is imported by the
+# functions that need it so that commands like `pipsi list` start fast.
 import json
 import os
-import pkgutil
 import sys
-import shutil
-import subprocess
-import glob
+import stat
 from collections import namedtuple
 from os.path import join, realpath, dirname, normpath, normcase
 from operator import methodcaller
-import distutils.spawn
+import errno
 import re
-try:
-    subprocess.run
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Tracer(object):
+    """Records how long the phases of pipsi's operations take.  The spans
+    can be summarized or exported in the Chrome trace event format, which
+    ``chrome://tracing`` and Perfetto can display.  Nothing is recorded
+    unless it is `enabled`.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.origin = time.time()
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': int((start - self.origin) * 1e6),
+                'dur': int((end - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        """Returns ``(name, count, seconds)`` for every kind of span, the
+        most expensive ones first.
+        """
+        totals = {}
+        with self._lock:
+            for event in self.events:
+                count, dur = totals.get(event['name'], (0, 0))
+                totals[event['name']] = (count + 1, dur + event['dur'])
+        return sorted(((name, count, dur / 1e6)
+                       for name, (count, dur) in totals.items()),
+                      key=lambda x: -x[2])
+
+    def write_chrome_trace(self, filename):
+        with self._lock:
+            events = list(self.events)
+        with open(filename, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+
+# Turned on by `--timings` and `--trace`, as the spans of a long running
+# process using `Repo` would otherwise pile up.
+tracer = Tracer(enabled=False)
+span = tracer.span
+
+
+def traced(name):
+    """Decorates a function so that every call is recorded as a span."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if sys.version_info >= (3, 5):
 
     def run(*args, **kw):
+        import subprocess
         kw.update(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        r = subprocess.run(*args, **kw)
+        with span('subprocess', argv=args[0]):
+            r = subprocess.run(*args, **kw)
         r.stdout, r.stderr = map(proc_output, (r.stdout, r.stderr))
         return r
-except AttributeError:  # no `subprocess.run`, py < 3.5
+else:  # no `subprocess.run`, py < 3.5
     CompletedProcess = namedtuple('CompletedProcess',
                                   ('args', 'returncode', 'stdout', 'stderr'))
 
     def run(argv, **kw):
-        p = subprocess.Popen(
-            argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kw)
-        out, err = map(proc_output, p.communicate())
+        import subprocess
+        with span('subprocess', argv=argv):
+            p = subprocess.Popen(
+                argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kw)
+            out, err = map(proc_output, p.communicate())
         return CompletedProcess(argv, p.returncode, out, err)
 try:
     from urlparse import urlparse
@@ -34,7 +114,6 @@ except ImportError:
     from urllib.parse import urlparse
 
 import click
-from pkg_resources import Requirement
 
 
 try:
@@ -46,8 +125,40 @@ else:
     IS_WIN = True
     BIN_DIR = 'Scripts'
 
-FIND_SCRIPTS_SCRIPT = pkgutil.get_data('pipsi', 'scripts/find_scripts.py').decode('utf-8')
-GET_VERSION_SCRIPT = pkgutil.get_data('pipsi', 'scripts/get_version.py').decode('utf-8')
+if IS_WIN:
+    import msvcrt
+
+    def _lock_fd(fd, blocking):
+        while 1:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except (IOError, OSError):
+                if not blocking:
+                    return False
+                time.sleep(0.1)
+
+    def _unlock_fd(fd):
+        os.lseek(fd, 0, 0)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_fd(fd, blocking):
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except (IOError, OSError) as e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def _unlock_fd(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+TEMPLATE_INFO = 'pipsi_template.json'
+INCOMPLETE_MARKER = '.pipsi-incomplete'
 
 # The `click` custom context settings
 CONTEXT_SETTINGS = dict(
@@ -55,11 +166,74 @@ CONTEXT_SETTINGS = dict(
 )
 
 
+# Per-thread output buffer.  While a package is processed as part of a
+# parallel batch its messages and subprocess output are collected here and
+# printed as one group once the package is done.
+_output = threading.local()
+
+
 def debugp(*args):
     if os.environ.get('PIPSI_DEBUG'):
         print(*args)
 
 
+def echo(message=''):
+    buf = getattr(_output, 'buffer', None)
+    if buf is None:
+        click.echo(message)
+    else:
+        buf.append(message)
+
+
+def call(args, **kw):
+    """Runs a command to completion and returns its exit code.  If the
+    current thread buffers its output the command output is captured into
+    that buffer line by line as it arrives instead of going straight to
+    the terminal.
+    """
+    import subprocess
+    debugp('Popen: {}'.format(args))
+    buf = getattr(_output, 'buffer', None)
+    with span('subprocess', argv=args):
+        if buf is None:
+            return subprocess.Popen(args, **kw).wait()
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, **kw)
+        try:
+            for line in iter(p.stdout.readline, b''):
+                buf.append(proc_output(line.rstrip()))
+        finally:
+            p.stdout.close()
+            p.wait()
+    return p.returncode
+
+
+# Processes started by `spawn` that might still be running.  They are only
+# kept around so that they are not reported as leaked while they work.
+_spawned = []
+
+
+def spawn(args):
+    """Starts a command in the background, detached from the terminal,
+    and returns without waiting for it.
+    """
+    import subprocess
+    debugp('spawn: {}'.format(args))
+    _spawned[:] = [p for p in _spawned if p.poll() is None]
+    kw = {}
+    if IS_WIN:
+        # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        kw['creationflags'] = 0x00000008 | 0x00000200
+    elif sys.version_info >= (3, 2):
+        kw['start_new_session'] = True
+    else:
+        kw['preexec_fn'] = os.setsid
+    with open(os.devnull, 'r+b') as devnull:
+        _spawned.append(subprocess.Popen(
+            args, stdin=devnull, stdout=devnull, stderr=devnull,
+            close_fds=not IS_WIN, **kw))
+
+
 def proc_output(s):
     s = s.strip()
     if  isinstance(s, bytes):
@@ -67,16 +241,85 @@ def proc_output(s):
     return s
 
 
+def get_helper_script(name):
+    """Returns the source of one of the scripts in `pipsi/scripts` that
+    are run with the interpreter of a virtualenv.
+    """
+    import pkgutil
+    return pkgutil.get_data('pipsi', 'scripts/' + name).decode('utf-8')
+
+
+_requirement_name_re = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+
+
+def requirement_name(value):
+    """Returns the project name of a requirement like ``Foo[bar]>=1.0``
+    with the same normalization as setuptools but without importing it.
+    """
+    match = _requirement_name_re.match(value)
+    if match is None:
+        raise ValueError('Invalid requirement: %r' % (value,))
+    return re.sub(r'[^A-Za-z0-9.]+', '-', match.group(1))
+
+
+def parse_specifier(value):
+    """Returns the version specifier of a requirement and a function to
+    parse versions for comparison.  Raises `ImportError` if neither
+    packaging nor setuptools is available.
+    """
+    try:
+        from packaging.requirements import Requirement
+        from packaging.version import parse as parse_version
+    except ImportError:
+        from pkg_resources import Requirement, parse_version
+        return Requirement.parse(value).specifier, parse_version
+    return Requirement(value).specifier, parse_version
+
+
 def normalize_package(value):
     # Strips the version and normalizes name
-    requirement = Requirement.parse(value)
-    return requirement.project_name.lower()
+    return requirement_name(value).lower()
 
 
 def normalize(path):
     return normcase(normpath(realpath(path)))
 
 
+def parse_size(value):
+    """Parses a human readable size like ``500M`` or ``2G`` into bytes."""
+    match = re.match(r'^\s*(\d+)\s*([kmgt]?)i?b?\s*$', str(value), re.I)
+    if match is None:
+        raise ValueError('Invalid size %r' % (value,))
+    number, unit = match.groups()
+    return int(number) * 1024 ** ' kmgt'.index(unit.lower() or ' ')
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return '%.1f %s' % (size, unit) if unit != 'B' else '%d B' % size
+
+
+def write_json(path, data):
+    """Atomically replaces the file at `path` with `data` as JSON."""
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(data, fh)
+        if IS_WIN and os.path.exists(path) and not hasattr(os, 'replace'):
+            os.remove(path)
+        getattr(os, 'replace', os.rename)(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
 def real_readlink(filename):
     try:
         target = os.readlink(filename)
@@ -88,8 +331,9 @@ def real_readlink(filename):
 def publish_script(src, dst):
     if IS_WIN:
         # always copy new exe on windows
+        import shutil
         shutil.copy(src, dst)
-        click.echo('  Copied Executable ' + dst)
+        echo('  Copied Executable ' + dst)
         return True
     else:
         old_target = real_readlink(dst)
@@ -104,32 +348,290 @@ def publish_script(src, dst):
         except OSError:
             pass
         else:
-            click.echo('  Linked script ' + dst)
+            echo('  Linked script ' + dst)
             return True
 
 
+def find_site_packages(virtualenv):
+    import glob
+    if IS_WIN:
+        return [join(virtualenv, 'Lib', 'site-packages')]
+    return glob.glob(join(virtualenv, 'lib', '*', 'site-packages'))
+
+
+def read_pyvenv_cfg(virtualenv):
+    """Returns the settings in the ``pyvenv.cfg`` of a virtualenv."""
+    rv = {}
+    try:
+        with open(join(virtualenv, 'pyvenv.cfg')) as fh:
+            for line in fh:
+                key, sep, value = line.partition('=')
+                if sep:
+                    rv[key.strip().lower()] = value.strip()
+    except (IOError, OSError):
+        pass
+    return rv
+
+
+def get_virtualenv_python_version(virtualenv):
+    """Returns ``(major, minor)`` of the interpreter of a virtualenv as
+    far as its layout and ``pyvenv.cfg`` tell, without starting it.
+    """
+    for path in find_site_packages(virtualenv):
+        match = re.search(r'python(\d+)\.(\d+)', path)
+        if match is not None:
+            return int(match.group(1)), int(match.group(2))
+    cfg = read_pyvenv_cfg(virtualenv)
+    match = re.match(r'(\d+)\.(\d+)',
+                     cfg.get('version') or cfg.get('version_info') or '')
+    if match is not None:
+        return int(match.group(1)), int(match.group(2))
+
+
+def has_working_interpreter(virtualenv):
+    """Checks without starting it whether the interpreter of a virtualenv
+    and the installation it is based on still exist.
+    """
+    if not os.path.exists(join(virtualenv, BIN_DIR,
+                               'python.exe' if IS_WIN else 'python')):
+        return False
+    home = read_pyvenv_cfg(virtualenv).get('home')
+    return not home or os.path.isdir(home)
+
+
+def get_optimize_levels():
+    """Returns the optimization levels tools are started with, which are
+    the ones worth byte-compiling for.
+    """
+    levels = set([0])
+    value = os.environ.get('PYTHONOPTIMIZE')
+    if value:
+        levels.add(min(int(value), 2) if value.isdigit() else 1)
+    return sorted(levels)
+
+
+@traced('compile')
+def compile_virtualenv(virtualenv, optimize=None):
+    """Byte-compiles the site-packages of a virtualenv with its own
+    interpreter for the given optimization levels, using all cores where
+    the interpreter supports it.  Only files whose source changed since
+    they were last compiled are compiled again.  Returns `False` if some
+    files could not be compiled.
+    """
+    if optimize is None:
+        optimize = get_optimize_levels()
+    args = ['-m', 'compileall', '-q']
+    version = get_virtualenv_python_version(virtualenv)
+    if version is not None and version >= (3, 5):
+        args += ['-j', '0']
+    ok = True
+    for level in optimize:
+        r = run([join(virtualenv, BIN_DIR, 'python')] + ['-O'] * level +
+                args + find_site_packages(virtualenv))
+        debugp('compileall -O{}: {}, {}'.format(level, r.returncode, r.stdout))
+        ok = ok and r.returncode == 0
+    return ok
+
+
+def find_distribution(virtualenv, package):
+    """Returns the path to the ``.dist-info`` or ``.egg-info`` folder of
+    `package` in the site-packages of `virtualenv`, or `None` if it cannot
+    be found that way (for instance for ``setup.py develop`` installs).
+    `package` can also be a requirement like ``foo[bar]>=1.0``.
+    """
+    try:
+        wanted = re.sub(r'[-_.]+', '-', requirement_name(package)).lower()
+    except ValueError:
+        return None
+    for path in find_site_packages(virtualenv):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            continue
+        for name in names:
+            base, ext = os.path.splitext(name)
+            if ext not in ('.dist-info', '.egg-info'):
+                continue
+            dist_name = re.sub(r'[-_.]+', '-', base.split('-')[0]).lower()
+            if dist_name == wanted and os.path.isdir(join(path, name)):
+                return join(path, name)
+
+
+def read_dist_version(dist):
+    """Reads the version from the metadata of a distribution folder."""
+    for name in ('METADATA', 'PKG-INFO'):
+        try:
+            with open(join(dist, name), 'rb') as fh:
+                for line in fh:
+                    line = line.decode('utf-8', 'replace').strip()
+                    if not line:
+                        break
+                    if line.startswith('Version:'):
+                        return line[8:].strip()
+        except (IOError, OSError):
+            continue
+
+
+def read_entry_points(dist, group='console_scripts'):
+    """Returns ``(name, target)`` for the entry points of `group` listed in
+    the ``entry_points.txt`` of a distribution folder.
+    """
+    try:
+        from ConfigParser import RawConfigParser
+    except ImportError:
+        from configparser import RawConfigParser
+    parser = RawConfigParser()
+    parser.optionxform = str
+    parser.read([join(dist, 'entry_points.txt')])
+    if not parser.has_section(group):
+        return []
+    return parser.items(group)
+
+
+def find_console_scripts(virtualenv):
+    """Returns a dict of the ``console_scripts`` entry points of all
+    distributions installed in `virtualenv`, mapping script names to
+    ``module:attr`` targets.
+    """
+    rv = {}
+    for path in find_site_packages(virtualenv):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            continue
+        for name in sorted(names):
+            if os.path.splitext(name)[1] in ('.dist-info', '.egg-info'):
+                rv.update(read_entry_points(join(path, name)))
+    return rv
+
+
+LAUNCHER_MARKER = '# pipsi launcher for '
+
+
+def make_launcher(virtualenv, target):
+    """Returns the source of a script that runs the entry point `target`
+    with the interpreter of `virtualenv`, or `None` if `target` is not a
+    ``module:attr`` entry point.  Unlike the wrappers generated for
+    setuptools installs it imports nothing but the target module.
+    """
+    module, _, attr = target.split('[')[0].strip().partition(':')
+    module, attr = module.strip(), attr.strip()
+    if not module or not attr:
+        return None
+    python = join(virtualenv, BIN_DIR, 'python')
+    # -I (Python 3.4+) keeps the environment, the user site-packages and
+    # the bin folder out of sys.path.  site itself is needed for .pth files.
+    flag = '-s'
+    if (get_virtualenv_python_version(virtualenv) or (0, 0)) >= (3, 4):
+        flag = '-I'
+    if len('#!%s %s' % (python, flag)) <= 127 and ' ' not in python:
+        shebang = ['#!%s %s' % (python, flag)]
+    else:
+        # Too long or not expressible as a shebang, start through sh
+        shebang = ['#!/bin/sh',
+                   '\'\'\'exec\' "%s" %s "$0" "$@"' % (python, flag),
+                   '\' \'\'\'']
+    return '\n'.join(shebang + [
+        LAUNCHER_MARKER + virtualenv,
+        'import sys',
+        'from %s import %s' % (module, attr.split('.')[0]),
+        'if __name__ == \'__main__\':',
+        '    sys.exit(%s())' % attr,
+        '',
+    ])
+
+
+def read_launcher_virtualenv(filename):
+    """Returns the virtualenv a launcher written by pipsi belongs to, or
+    `None` if `filename` is no such launcher.
+    """
+    try:
+        with open(filename, 'rb') as fh:
+            head = fh.read(4096).decode('utf-8', 'replace')
+    except (IOError, OSError):
+        return None
+    for line in head.splitlines()[:4]:
+        if line.startswith(LAUNCHER_MARKER):
+            return line[len(LAUNCHER_MARKER):]
+
+
+def write_launcher(source, dst):
+    try:
+        with open(dst, 'r') as fh:
+            if fh.read() == source:
+                return True
+    except (IOError, OSError, UnicodeDecodeError):
+        pass
+    tmp = '%s.pipsi-%d' % (dst, os.getpid())
+    with open(tmp, 'w') as fh:
+        fh.write(source)
+    os.chmod(tmp, 0o755)
+    getattr(os, 'replace', os.rename)(tmp, dst)
+    echo('  Wrote launcher ' + dst)
+    return True
+
+
+def read_installed_files(virtualenv, package, prefix):
+    """Lists the files of `package` below `prefix` by reading the metadata
+    of the installed distribution directly.  Returns `None` if the
+    distribution cannot be found, in which case the caller needs to fall
+    back to asking the interpreter of the virtualenv.
+    """
+    dist = find_distribution(virtualenv, package)
+    if dist is None:
+        return None
+
+    # Only the folder is resolved, the entries are joined to it without
+    # touching the file system as RECORD can list thousands of files.
+    if os.path.isfile(join(dist, 'RECORD')):
+        import csv
+        base = realpath(dirname(dist))
+        with open(join(dist, 'RECORD'), 'r') as fh:
+            entries = [row[0] for row in csv.reader(fh) if row]
+    elif os.path.isfile(join(dist, 'installed-files.txt')):
+        base = realpath(dist)
+        with open(join(dist, 'installed-files.txt'), 'r') as fh:
+            entries = [line.split(',')[0] for line in fh.read().splitlines()]
+    else:
+        base = prefix
+        entries = [name for name, _ in read_entry_points(dist)]
+
+    files = (normcase(normpath(join(base, entry))) for entry in entries)
+    return [filename for filename in files if filename.startswith(prefix)]
+
+
+@traced('extract version')
 def extract_package_version(virtualenv, package):
+    dist = find_distribution(virtualenv, package)
+    if dist is not None:
+        version = read_dist_version(dist)
+        if version:
+            return version
+
     prefix = normalize(join(virtualenv, BIN_DIR, ''))
 
     return run([
-        join(prefix, 'python'), '-c', GET_VERSION_SCRIPT,
+        join(prefix, 'python'), '-c', get_helper_script('get_version.py'),
         package,
     ]).stdout.strip()
 
 
+@traced('find scripts')
 def find_scripts(virtualenv, package):
     prefix = normalize(join(virtualenv, BIN_DIR, ''))
 
-    files = run([
-        join(prefix, 'python'), '-c', FIND_SCRIPTS_SCRIPT,
-        package, prefix
-    ]).stdout.splitlines()
+    files = read_installed_files(virtualenv, package, prefix)
+    if files is None:
+        files = run([
+            join(prefix, 'python'), '-c', get_helper_script('find_scripts.py'),
+            package, prefix
+        ]).stdout.splitlines()
 
-    files = map(normalize, files)
-    files = filter(
-        methodcaller('startswith', prefix),
-        files,
-    )
+        files = map(normalize, files)
+        files = list(filter(
+            methodcaller('startswith', prefix),
+            files,
+        ))
 
     def valid(filename):
         return os.path.isfile(filename) and \
@@ -138,24 +640,372 @@ def find_scripts(virtualenv, package):
     result = list(filter(valid, files))
 
     if IS_WIN:
+        import glob
         for filename in files:
             globed = glob.glob(filename + '*')
             result.extend(filter(valid, globed))
     return result
 
 
+@traced('relocate virtualenv')
+def relocate_virtualenv(venv_path, old_path, new_path):
+    """Rewrites references to `old_path` in the scripts and configuration
+    of the virtualenv at `venv_path` (shebangs, activation scripts and
+    ``pyvenv.cfg``) so that they point to `new_path` instead.
+    """
+    import shutil
+    fsencode = getattr(os, 'fsencode', lambda x: x)
+    old, new = fsencode(old_path), fsencode(new_path)
+    bin_path = join(venv_path, BIN_DIR)
+    candidates = [join(venv_path, 'pyvenv.cfg')]
+    candidates.extend(join(bin_path, name) for name in os.listdir(bin_path))
+    for filename in candidates:
+        if os.path.islink(filename) or not os.path.isfile(filename):
+            continue
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        if old not in data:
+            continue
+        # Write a new file instead of changing it in place in case the
+        # file is hardlinked with another one.
+        tmp = filename + '.pipsi-tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(data.replace(old, new))
+        shutil.copymode(filename, tmp)
+        getattr(os, 'replace', os.rename)(tmp, filename)
+
+
+def clone_virtualenv(template, venv_path):
+    """Creates the virtualenv `venv_path` as a copy of `template`."""
+    import shutil
+    shutil.copytree(template, venv_path, symlinks=True,
+                    ignore=shutil.ignore_patterns(TEMPLATE_INFO))
+    relocate_virtualenv(venv_path, template, venv_path)
+
+
+# Classes of files `slim_virtualenv` can remove.  Removing setuptools
+# breaks tools that use `pkg_resources` without declaring it, which is
+# why it is not removed by default.
+SLIM_CLASSES = ('tests', 'docs', 'headers', 'bytecode', 'pip', 'setuptools')
+DEFAULT_SLIM_CLASSES = ('tests', 'docs', 'headers', 'bytecode', 'pip')
+SLIM_DISTRIBUTIONS = {'pip': ('pip', 'wheel'), 'setuptools': ('setuptools',)}
+_pyc_tag_re = re.compile(r'\.[a-z]+-(\d)(\d+)(?:\.opt-\d)?\.pyc$')
+
+
+def read_required_names(virtualenv):
+    """Returns the normalized names of all distributions the ones in the
+    site-packages of `virtualenv` depend on, not counting extras.
+    """
+    names = set()
+    for path in find_site_packages(virtualenv):
+        for name in os.listdir(path):
+            if name.endswith('.dist-info'):
+                metadata = 'METADATA'
+                pattern = r'(?m)^Requires-Dist:\s*([\w.-]+)(?!.*extra\s*==)'
+            elif name.endswith('.egg-info'):
+                metadata, pattern = 'requires.txt', r'(?m)^([\w.-]+)'
+            else:
+                continue
+            try:
+                with open(join(path, name, metadata), 'rb') as fh:
+                    text = fh.read().decode('utf-8', 'replace')
+            except (IOError, OSError):
+                continue
+            # Requirements of extras follow in sections of requires.txt
+            text = text.split('\n[')[0]
+            names.update(re.sub(r'[-_.]+', '-', requirement).lower()
+                         for requirement in re.findall(pattern, text))
+    return names
+
+
+def _read_record(dist):
+    """Returns the lines of the ``RECORD`` of a distribution folder
+    together with the normalized paths they refer to.
+    """
+    import csv
+    base = realpath(dirname(dist))
+    try:
+        with open(join(dist, 'RECORD'), 'r') as fh:
+            lines = fh.read().splitlines()
+    except (IOError, OSError):
+        return []
+    rv = []
+    for line in lines:
+        row = next(csv.reader([line]), None)
+        path = row and normcase(normpath(join(base, row[0])))
+        rv.append((line, path))
+    return rv
+
+
+def find_slim_files(virtualenv, classes=DEFAULT_SLIM_CLASSES):
+    """Returns the normalized paths of the files of a virtualenv that
+    belong to the given classes (see `SLIM_CLASSES`).  The metadata of the
+    remaining distributions is never included, so pipsi can still find
+    their scripts and versions.
+    """
+    files = set()
+
+    def _add_tree(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            files.update(normcase(normpath(join(dirpath, name)))
+                         for name in filenames + [
+                             name for name in dirnames
+                             if os.path.islink(join(dirpath, name))])
+
+    junk_dirs = set()
+    if 'tests' in classes:
+        junk_dirs.update(('test', 'tests'))
+    if 'docs' in classes:
+        junk_dirs.update(('doc', 'docs', 'examples'))
+    if 'headers' in classes:
+        _add_tree(join(virtualenv, 'include'))
+    if 'docs' in classes:
+        _add_tree(join(virtualenv, 'share', 'doc'))
+
+    version = get_virtualenv_python_version(virtualenv)
+    for site_packages in find_site_packages(virtualenv):
+        site_packages = realpath(site_packages)
+        for dirpath, dirnames, filenames in os.walk(site_packages):
+            for name in list(dirnames):
+                if name.endswith(('.dist-info', '.egg-info')):
+                    dirnames.remove(name)
+                elif name.lower() in junk_dirs:
+                    dirnames.remove(name)
+                    _add_tree(join(dirpath, name))
+            for name in filenames:
+                filename = join(dirpath, name)
+                if 'headers' in classes and name.endswith(('.h', '.hpp')):
+                    files.add(normcase(normpath(filename)))
+                elif 'bytecode' in classes and name.endswith('.pyc') and \
+                        os.path.basename(dirpath) == '__pycache__':
+                    match = _pyc_tag_re.search(name)
+                    source = join(dirname(dirpath), name.split('.')[0] + '.py')
+                    if match is None or not os.path.exists(source) or (
+                            version is not None and version != (
+                                int(match.group(1)), int(match.group(2)))):
+                        files.add(normcase(normpath(filename)))
+
+    # Distributions are only removed as a whole and if nothing needs them
+    required = None
+    for cls in ('pip', 'setuptools'):
+        if cls not in classes:
+            continue
+        if required is None:
+            required = read_required_names(virtualenv)
+        for package in SLIM_DISTRIBUTIONS[cls]:
+            dist = find_distribution(virtualenv, package)
+            if dist is None or package in required or \
+               not os.path.isfile(join(dist, 'RECORD')):
+                continue
+            files.update(path for line, path in _read_record(dist) if path)
+    return files
+
+
+@traced('slim')
+def slim_virtualenv(virtualenv, classes=DEFAULT_SLIM_CLASSES):
+    """Removes the files of the given classes from a virtualenv and the
+    entries for them from the ``RECORD`` files of its distributions.
+    Returns the number of files removed and their size in bytes.
+    """
+    import shutil
+    removed = set()
+    freed = 0
+    for filename in find_slim_files(virtualenv, classes):
+        try:
+            st = os.lstat(filename)
+            os.remove(filename)
+        except OSError:
+            continue
+        removed.add(filename)
+        freed += st.st_size
+
+    for site_packages in find_site_packages(virtualenv):
+        for name in os.listdir(site_packages):
+            dist = join(site_packages, name)
+            if not name.endswith('.dist-info') or \
+               not os.path.isfile(join(dist, 'RECORD')):
+                continue
+            lines = _read_record(dist)
+            kept = [line for line, path in lines if path not in removed]
+            if len(kept) != len(lines):
+                # RECORD might be hardlinked to other virtualenvs by
+                # dedupe, so it is replaced instead of written to.
+                record = join(dist, 'RECORD')
+                tmp = record + '.pipsi-tmp'
+                with open(tmp, 'w') as fh:
+                    fh.write(''.join(line + '\n' for line in kept))
+                shutil.copymode(record, tmp)
+                getattr(os, 'replace', os.rename)(tmp, record)
+
+    # Remove the folders that were emptied, deepest first, but never the
+    # site-packages or the folders above them.
+    root = normcase(normpath(realpath(virtualenv)))
+    keep = set([root])
+    for path in find_site_packages(virtualenv):
+        path = normcase(normpath(realpath(path)))
+        while path.startswith(root):
+            keep.add(path)
+            path = dirname(path)
+    for folder in sorted(set(dirname(filename) for filename in removed),
+                         key=len, reverse=True):
+        while folder.startswith(root + os.sep) and folder not in keep:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = dirname(folder)
+    return len(removed), freed
+
+
+BUNDLE_INFO = 'pipsi-bundle.json'
+
+
+def extract_bundle(tar, dest):
+    """Extracts the virtualenv from the remaining members of a bundle that
+    is read as a stream into `dest`.  Members that would end up outside of
+    `dest`, directly or through a symlink extracted before, are refused
+    with a `ValueError`.
+    """
+    import tarfile
+    kw = {}
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        # the members are checked below, links to the interpreter outside
+        # of the virtualenv are expected
+        kw['filter'] = 'fully_trusted'
+
+    def _relative(name):
+        parts = name.split('/')
+        if parts[0] != 'venv' or '..' in parts or '' in parts[1:]:
+            raise ValueError('Refusing to extract %s from bundle' % name)
+        for i in range(2, len(parts) + 1):
+            if '/'.join(parts[1:i]) in links:
+                raise ValueError('Refusing to extract %s from bundle' % name)
+        return '/'.join(parts[1:])
+
+    links = set()
+    os.makedirs(dest)
+    while True:
+        member = tar.next()
+        if member is None:
+            break
+        member.name = _relative(member.name)
+        if not member.name:
+            continue
+        if member.issym():
+            links.add(member.name)
+        elif member.islnk():
+            member.linkname = _relative(member.linkname)
+        # Never write through whatever an earlier member left at the path
+        path = join(dest, member.name)
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.remove(path)
+        tar.extract(member, dest, **kw)
+
+
+def is_index_source(source):
+    """Tells by the recorded source of a package whether it was installed
+    from a package index rather than from a folder or URL.
+    """
+    return not source or not ('://' in source or os.path.isabs(source))
+
+
+def interpreter_stamp(python):
+    st = os.stat(realpath(python))
+    return [st.st_size, int(st.st_mtime)]
+
+
+class FileLock(object):
+    """An exclusive lock on a file that is honoured by other pipsi
+    processes as well as other threads.  A thread that already holds the
+    lock can acquire it again.
+    """
+    _local = threading.local()
+
+    def __init__(self, path):
+        self.path = path
+
+    def _held(self):
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def acquire(self, blocking=True):
+        held = self._held()
+        if self.path in held:
+            held[self.path][1] += 1
+            return True
+        if not os.path.isdir(dirname(self.path)):
+            try:
+                os.makedirs(dirname(self.path))
+            except OSError:
+                if not os.path.isdir(dirname(self.path)):
+                    raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not _lock_fd(fd, blocking):
+                os.close(fd)
+                return False
+        except Exception:
+            os.close(fd)
+            raise
+        held[self.path] = [fd, 1]
+        return True
+
+    def release(self):
+        held = self._held()
+        entry = held[self.path]
+        entry[1] -= 1
+        if not entry[1]:
+            del held[self.path]
+            _unlock_fd(entry[0])
+            os.close(entry[0])
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
 class UninstallInfo(object):
 
-    def __init__(self, package, paths=None, installed=True):
+    def __init__(self, package, paths=None, installed=True, repo=None):
         self.package = package
         self.paths = paths or []
         self.installed = installed
+        self.repo = repo
 
-    def perform(self):
+    @traced('uninstall')
+    def perform(self, background=True):
+        """Removes the scripts and the virtualenv.  With a repo the
+        virtualenv is only moved to its trash and deleted in the
+        background (or by `pipsi gc` if that does not happen).
+        """
+        if self.repo is None:
+            return self._remove_paths()
+        venv = os.path.basename(self.repo.get_package_path(self.package))
+        trashed = []
+        with self.repo.package_lock(venv):
+            with self.repo.lock('bin'):
+                self._remove_paths(trashed)
+            self.repo.forget(self.package)
+        if trashed:
+            self.repo.empty_trash(trashed, background=background)
+
+    def _remove_paths(self, trashed=None):
+        import shutil
         for path in self.paths:
             try:
                 os.remove(path)
             except OSError:
+                if trashed is not None:
+                    try:
+                        trashed.append(self.repo.trash(path))
+                        continue
+                    except OSError:
+                        pass
                 shutil.rmtree(path)
 
 
@@ -209,12 +1059,501 @@ def get_real_python(python):
     raise ValueError('Can not find real python under {}'.format(real_prefix))
 
 
+def find_executable(name):
+    """Looks up a command in PATH."""
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+    return which(name)
+
+
+def find_python(major):
+    """Finds the ``pythonX`` executable for a major version in PATH."""
+    python_exe = 'python{}'.format(major)
+    python = find_executable(python_exe)
+    if not python:
+        raise ValueError('Can not find {} in PATH'.format(python_exe))
+    return python
+
+
+def locate_python(python):
+    """Returns the path of an interpreter given as a path or as a command
+    name, which is looked up in PATH like the shell would.
+    """
+    if os.sep in python or (os.altsep and os.altsep in python):
+        if not os.path.exists(python):
+            raise ValueError('Can not find {}'.format(python))
+        return python
+    path = find_executable(python)
+    if not path:
+        raise ValueError('Can not find {} in PATH'.format(python))
+    return path
+
+
+class PythonRegistry(object):
+    """Remembers what pipsi found out about the interpreters it used so
+    that they do not need to be started again for every install.  Entries
+    are keyed by the resolved interpreter path and are probed again as soon
+    as the inode, mtime or size of the binary changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {'pythons': {}, 'path': {}}
+
+    def _save(self, data):
+        if not os.path.isdir(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        write_json(self.path, data)
+
+    @staticmethod
+    def _stamp(resolved):
+        st = os.stat(resolved)
+        return [st.st_ino, st.st_mtime, st.st_size]
+
+    def find(self, major):
+        """Like `find_python` but remembers the result for the current
+        PATH as long as the executable exists.
+        """
+        key = '%s:%s' % (major, os.environ.get('PATH', ''))
+        with self._lock:
+            data = self._load()
+            python = data['path'].get(key)
+            if python and os.path.isfile(python):
+                return python
+            python = find_python(major)
+            data['path'][key] = python
+            self._save(data)
+        return python
+
+    @traced('probe interpreter')
+    def probe(self, python, refresh=False):
+        """Returns the version, real prefix and base interpreter of
+        `python` as a dict, probing the interpreter only if it is unknown
+        or changed since it was last probed.  Raises `ValueError` if the
+        interpreter cannot be found.
+        """
+        python = locate_python(python)
+        resolved = realpath(python)
+        stamp = self._stamp(resolved)
+        with self._lock:
+            data = self._load()
+            info = data['pythons'].get(resolved)
+            if info is not None and info['stamp'] == stamp and not refresh:
+                return info
+            real_python = get_real_python(python)
+            info = {
+                'python': resolved,
+                'stamp': stamp,
+                'version': list(get_python_semver(python)),
+                'real_python': real_python,
+                'real_prefix': '' if real_python == python
+                else dirname(dirname(real_python)),
+            }
+            data['pythons'][resolved] = info
+            self._save(data)
+        return info
+
+    def known(self):
+        return sorted(self._load()['pythons'].values(),
+                      key=lambda info: info['python'])
+
+    def refresh(self):
+        """Probes all known interpreters again and forgets about the ones
+        that disappeared.  Returns the interpreters that were removed.
+        """
+        removed = []
+        for info in self.known():
+            try:
+                self.probe(info['python'], refresh=True)
+            except (OSError, ValueError):
+                removed.append(info['python'])
+        with self._lock:
+            data = self._load()
+            for python in removed:
+                data['pythons'].pop(python, None)
+            data['path'] = {}
+            self._save(data)
+        return removed
+
+
+class Wheelhouse(object):
+    """A folder of wheels shared by all virtualenvs of a repo.  Wheels are
+    stored under their file name, which carries the name, version and tag of
+    the distribution.  An index next to them tracks when each wheel was last
+    used so that the least recently used ones can be evicted once the
+    wheelhouse grows beyond `max_size` bytes.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.index_path = join(path, 'index.json')
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def wheels(self):
+        """Returns ``(filename, size, last_used)`` for every stored wheel,
+        least recently used first.
+        """
+        import glob
+        index = self._load_index()
+        rv = []
+        for filename in glob.glob(join(self.path, '*.whl')):
+            st = os.stat(filename)
+            name = os.path.basename(filename)
+            rv.append((name, st.st_size, index.get(name, st.st_mtime)))
+        rv.sort(key=lambda x: (x[2], x[0]))
+        return rv
+
+    def add(self, wheel_dir):
+        """Stores all wheels from `wheel_dir` that are not known yet and
+        marks all of them as used.
+        """
+        import glob
+        import shutil
+        now = time.time()
+        with self._lock:
+            index = self._load_index()
+            for filename in glob.glob(join(wheel_dir, '*.whl')):
+                name = os.path.basename(filename)
+                dst = join(self.path, name)
+                if not os.path.isfile(dst):
+                    tmp = join(self.path, '.tmp-' + name)
+                    try:
+                        os.link(filename, tmp)
+                    except (OSError, AttributeError):
+                        shutil.copy2(filename, tmp)
+                    getattr(os, 'replace', os.rename)(tmp, dst)
+                index[name] = now
+            write_json(self.index_path, index)
+
+    def prune(self, max_size=None):
+        """Evicts the least recently used wheels until the wheelhouse is no
+        larger than `max_size` (defaults to the configured size).  Returns the
+        removed wheels as ``(filename, size)`` tuples.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+        removed = []
+        with self._lock:
+            wheels = self.wheels()
+            total = sum(size for _, size, _ in wheels)
+            for name, size, _ in wheels:
+                if total <= max_size:
+                    break
+                try:
+                    os.remove(join(self.path, name))
+                except OSError:
+                    continue
+                total -= size
+                removed.append((name, size))
+            if removed:
+                index = self._load_index()
+                for name, _ in removed:
+                    index.pop(name, None)
+                write_json(self.index_path, index)
+        return removed
+
+
+_toml_table_re = re.compile(r'^\s*\[\s*([^\[\]]+?)\s*\]\s*(#.*)?$')
+_toml_name_re = re.compile(
+    r'''^\s*name\s*=\s*(?:"([^"\\]+)"|'([^']+)')\s*(#.*)?$''')
+
+
+def read_static_package_name(location):
+    """Returns the name of the local package at `location` as declared in
+    the ``[project]`` table of its ``pyproject.toml`` or the ``[metadata]``
+    section of its ``setup.cfg``, or `None` if neither declares it.
+    """
+    try:
+        with open(join(location, 'pyproject.toml'), 'rb') as fh:
+            table = None
+            for line in fh.read().decode('utf-8').splitlines():
+                match = _toml_table_re.match(line)
+                if match is not None:
+                    table = match.group(1)
+                elif table == 'project':
+                    match = _toml_name_re.match(line)
+                    if match is not None:
+                        return match.group(1) or match.group(2)
+    except (IOError, OSError, UnicodeDecodeError):
+        pass
+
+    try:
+        from configparser import RawConfigParser, Error
+    except ImportError:  # py2
+        from ConfigParser import RawConfigParser, Error
+    parser = RawConfigParser()
+    try:
+        parser.read(join(location, 'setup.cfg'))
+        name = parser.get('metadata', 'name').strip()
+    except Error:
+        return None
+    # `attr:` and `file:` directives need setuptools to be resolved
+    if name and ':' not in name:
+        return name
+
+
+def hash_file(filename, chunk_size=65536):
+    import hashlib
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        while 1:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FileStore(object):
+    """A content addressed store used to replace identical files of
+    different virtualenvs with hardlinks to a single copy.  Every file that
+    was processed is remembered with its size and mtime so that unchanged
+    files are not hashed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state_path = join(path, 'state.json')
+        self._lock = threading.Lock()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def dedupe(self, roots, prune=False):
+        """Hardlinks all regular files below `roots` to the store.  With
+        `prune` only files below `roots` are remembered afterwards.  Returns
+        the number of files replaced by hardlinks and the bytes saved.
+        """
+        linked = saved = 0
+        with self._lock:
+            state = self._load_state()
+            prefixes = tuple(join(root, '') for root in roots)
+            new_state = {} if prune else dict(
+                (k, v) for k, v in state.items() if not k.startswith(prefixes))
+            for root in roots:
+                for dirpath, dirnames, filenames in os.walk(root):
+                    for name in filenames:
+                        filename = join(dirpath, name)
+                        try:
+                            st = os.lstat(filename)
+                        except OSError:
+                            continue
+                        if not stat.S_ISREG(st.st_mode) or not st.st_size:
+                            continue
+                        known = state.get(filename)
+                        if known and known[:2] == [st.st_size, st.st_mtime]:
+                            new_state[filename] = known
+                            continue
+                        digest = hash_file(filename)
+                        try:
+                            if self._link(filename, st, digest):
+                                linked += 1
+                                saved += st.st_size
+                                st = os.lstat(filename)
+                        except OSError as e:
+                            debugp('Cannot dedupe {}: {}'.format(filename, e))
+                            continue
+                        new_state[filename] = [st.st_size, st.st_mtime, digest]
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            write_json(self.state_path, new_state)
+        return linked, saved
+
+    def _link(self, filename, st, digest):
+        # Files only share an object if their permissions match as well
+        obj = join(self.path, 'objects', digest[:2],
+                   '%s-%o' % (digest, stat.S_IMODE(st.st_mode)))
+        try:
+            ost = os.stat(obj)
+        except OSError:
+            if not os.path.isdir(dirname(obj)):
+                os.makedirs(dirname(obj))
+            os.link(filename, obj)
+            return False
+        if (ost.st_dev, ost.st_ino) == (st.st_dev, st.st_ino):
+            return False
+        tmp = filename + '.pipsi-tmp'
+        os.link(obj, tmp)
+        getattr(os, 'replace', os.rename)(tmp, filename)
+        return True
+
+    def collect(self):
+        """Removes stored objects that no virtualenv links to anymore and
+        returns the number of bytes freed.
+        """
+        freed = 0
+        with self._lock:
+            for dirpath, dirnames, filenames in \
+                    os.walk(join(self.path, 'objects')):
+                for name in filenames:
+                    obj = join(dirpath, name)
+                    st = os.lstat(obj)
+                    if st.st_nlink <= 1:
+                        os.remove(obj)
+                        freed += st.st_size
+        return freed
+
+
+def map_jobs(func, items, jobs=1):
+    """Like `map` but calls `func` from up to `jobs` threads at a time."""
+    items = list(items)
+    jobs = max(1, min(jobs, len(items)))
+    if jobs == 1:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class PackageResult(object):
+    """The outcome of one package of `Repo.install_many`,
+    `Repo.upgrade_many` or `Repo.uninstall_many`.
+
+    `status` is one of ``'pending'``, ``'running'``, ``'installed'``,
+    ``'already-installed'``, ``'upgraded'``, ``'up-to-date'``,
+    ``'uninstalled'``, ``'not-installed'`` or ``'failed'``.  `log` holds
+    the messages of pipsi and the output of pip, `error` the exception a
+    failed package raised, if any.
+    """
+
+    OK = ('installed', 'upgraded', 'up-to-date', 'uninstalled')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.package = None
+        self.status = 'pending'
+        self.version = None
+        self.scripts = []
+        self.log = []
+        self.error = None
+        self.started_at = None
+        self.seconds = None
+
+    @property
+    def ok(self):
+        return self.status in self.OK
+
+    def to_dict(self):
+        return {
+            'spec': self.spec,
+            'package': self.package,
+            'status': self.status,
+            'ok': self.ok,
+            'version': self.version,
+            'scripts': self.scripts,
+            'log': self.log,
+            'error': None if self.error is None else str(self.error),
+            'started_at': self.started_at,
+            'seconds': self.seconds,
+        }
+
+    def __repr__(self):
+        return '<PackageResult %s: %s>' % (self.spec, self.status)
+
+
+class _LogBuffer(list):
+    """Output buffer of a thread that reports every line as it arrives."""
+
+    def __init__(self, callback):
+        list.__init__(self)
+        self.callback = callback
+
+    def append(self, line):
+        list.append(self, line)
+        self.callback(line)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+
+def run_packages(func, specs, jobs=1, progress=None):
+    """Calls ``func(result)`` with a `PackageResult` for every spec, up to
+    `jobs` of them at a time, and returns the results in the order of
+    `specs`.  `func` sets the status and package of the result.  Nothing
+    is printed, all output ends up in the log of the results.
+
+    `progress` is called as ``progress(event, result)`` when a package is
+    ``'started'``, for every line of ``'output'`` (the last line of its
+    log) and once it is ``'finished'``.  With more than one job it is
+    called from several threads.
+    """
+    def _notify(event, result):
+        if progress is not None:
+            progress(event, result)
+
+    def work(result):
+        old_buffer = getattr(_output, 'buffer', None)
+        _output.buffer = _LogBuffer(
+            lambda line: _notify('output', result))
+        result.log = _output.buffer
+        result.status = 'running'
+        result.started_at = time.time()
+        _notify('started', result)
+        try:
+            func(result)
+        except Exception as e:
+            result.status = 'failed'
+            result.error = e
+            echo('Error: %s' % e)
+        finally:
+            _output.buffer = old_buffer
+            result.log = list(result.log)
+            result.seconds = time.time() - result.started_at
+        _notify('finished', result)
+        return result
+
+    return map_jobs(work, [PackageResult(spec) for spec in specs], jobs)
+
+
 class Repo(object):
 
-    def __init__(self, home, bin_dir):
+    def __init__(self, home, bin_dir, use_wheelhouse=False,
+                 wheelhouse_size=None, use_templates=True, auto_dedupe=False,
+                 use_launchers=False):
         self.home = realpath(home)
         self.bin_dir = bin_dir
-
+        self.use_templates = use_templates
+        self.auto_dedupe = auto_dedupe
+        self.use_launchers = use_launchers and not IS_WIN
+        self.store = FileStore(join(self.home, '.store'))
+        self.pythons = PythonRegistry(join(self.home, '.pythons.json'))
+        self.index_path = join(self.home, '.index.json')
+        self.trash_dir = join(self.home, '.trash')
+        self.names_path = join(self.home, '.names.json')
+        self._template_lock = threading.Lock()
+        self.use_wheelhouse = use_wheelhouse
+        self.wheelhouse = Wheelhouse(join(self.home, '.wheelhouse'),
+                                     wheelhouse_size)
+
+    @traced('resolve package')
     def resolve_package(self, spec, python=None):
         url = urlparse(spec)
         if url.netloc == 'file':
@@ -230,9 +1569,30 @@ class Repo(object):
         else:
             return spec, [spec]
 
-        if not os.path.exists(join(location, 'setup.py')):
-            raise click.UsageError('%s does not appear to be a local '
-                                   'Python package.' % spec)
+        name = read_static_package_name(location)
+        if name is None:
+            if not os.path.exists(join(location, 'setup.py')):
+                raise click.UsageError('%s does not appear to be a local '
+                                       'Python package.' % spec)
+            name = self._setup_py_name(spec, location, python)
+
+        return name, [location]
+
+    def _setup_py_name(self, spec, location, python=None):
+        """Runs ``setup.py --name``.  The result is remembered for as long
+        as the build files of the package do not change.
+        """
+        import hashlib
+        h = hashlib.sha256(os.path.abspath(location).encode('utf-8'))
+        for filename in ('setup.py', 'setup.cfg', 'pyproject.toml'):
+            if os.path.isfile(join(location, filename)):
+                h.update(('\0%s\0' % filename).encode('utf-8'))
+                h.update(hash_file(join(location, filename)).encode('ascii'))
+        key = h.hexdigest()
+
+        name = self._load_names().get(key)
+        if name is not None:
+            return name
 
         res = run(
             [python or sys.executable, 'setup.py', '--name'],
@@ -244,200 +1604,1370 @@ class Repo(object):
             )
         name = res.stdout
 
-        return name, [location]
+        with self.lock('names'):
+            names = self._load_names()
+            names[key] = name
+            write_json(self.names_path, names)
+        return name
 
-    def get_package_path(self, package):
-        return join(self.home, normalize_package(package))
+    def _load_names(self):
+        try:
+            with open(self.names_path, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def lock(self, name):
+        """Returns the lock with the given name.  ``bin`` guards the bin
+        folder, ``index`` the package index and ``names`` the cache of
+        package names.
+        """
+        return FileLock(join(self.home, '.locks', name + '.lock'))
 
-    def find_installed_executables(self, path):
-        prefix = join(realpath(normpath(path)), '')
+    def package_lock(self, venv):
+        """Returns the lock of the package with the given virtualenv name.
+        These live in a folder of their own so that a package called like
+        one of the other locks does not hold that lock.
+        """
+        return FileLock(join(self.home, '.locks', 'packages', venv + '.lock'))
+
+    def trash(self, path):
+        """Atomically moves `path` into the trash folder of the home and
+        returns the folder it now lives in.
+        """
+        import tempfile
+        if not os.path.isdir(self.trash_dir):
+            try:
+                os.makedirs(self.trash_dir)
+            except OSError:
+                if not os.path.isdir(self.trash_dir):
+                    raise
+        entry = tempfile.mkdtemp(prefix=os.path.basename(path) + '+',
+                                 dir=self.trash_dir)
         try:
-            for filename in os.listdir(self.bin_dir):
-                exe = os.path.join(self.bin_dir, filename)
-                target = real_readlink(exe)
-                if target is None:
-                    continue
-                if target.startswith(prefix):
-                    yield exe
+            os.rename(path, join(entry, os.path.basename(path)))
         except OSError:
-            pass
+            os.rmdir(entry)
+            raise
+        return entry
 
-    def get_package_scripts(self, path):
-        """Get the scripts installed for PATH
+    def empty_trash(self, entries=None, background=False):
+        """Deletes the given entries of the trash, or all of them.  With
+        `background` a separate process deletes them and this returns at
+        once.  Returns the entries that were (or are being) deleted.
 
-        Looks for package metadata listing which scripts were
-        installed. If there is no metadata (package was installed
-         with an older version of pipsi) then fall back to the old
-         find_installed_executables method.
+        Without `entries` only the entries of packages nobody holds the
+        lock of are deleted, with that lock held, as an operation on the
+        package might still move its entry back.  This ignores
+        `background`.
         """
-        info = self.get_package_info(path)
-        if 'scripts' in info:
+        import shutil
+        if entries is None:
+            names = sorted(os.listdir(self.trash_dir)) \
+                if os.path.isdir(self.trash_dir) else []
+            entries = []
+            for name in names:
+                lock = self.package_lock(name.split('+')[0])
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    entry = join(self.trash_dir, name)
+                    if os.path.exists(entry):
+                        shutil.rmtree(entry, ignore_errors=True)
+                        entries.append(entry)
+                finally:
+                    lock.release()
+            return entries
+        if background and entries:
+            spawn([sys.executable, '-c',
+                   'import shutil, sys\n'
+                   'for path in sys.argv[1:]:\n'
+                   '    shutil.rmtree(path, True)'] + entries)
+        else:
+            for entry in entries:
+                shutil.rmtree(entry, ignore_errors=True)
+        return entries
+
+    def find_orphaned_scripts(self):
+        """Returns the links and launchers in the bin folder that point
+        into the home folder but whose target is gone.
+        """
+        orphans = []
+        if not os.path.isdir(self.bin_dir):
+            return orphans
+        for name in sorted(os.listdir(self.bin_dir)):
+            path = join(self.bin_dir, name)
+            if os.path.islink(path):
+                if os.path.exists(path):
+                    continue
+                target = join(self.bin_dir, os.readlink(path))
+            else:
+                target = read_launcher_virtualenv(path)
+                if target is None or os.path.isdir(target):
+                    continue
+            if realpath(target).startswith(join(self.home, '')):
+                orphans.append(path)
+        return orphans
+
+    def find_abandoned_builds(self):
+        """Returns the staging folders and virtualenvs of installs that
+        crashed.  Builds of packages that are currently being installed
+        are skipped.
+        """
+        abandoned = []
+        candidates = []
+        staging_dir = join(self.home, '.staging')
+        if os.path.isdir(staging_dir):
+            candidates.extend((join(staging_dir, name), name.split('+')[0])
+                              for name in sorted(os.listdir(staging_dir)))
+        if os.path.isdir(self.home):
+            candidates.extend(
+                (join(self.home, name), name)
+                for name in sorted(os.listdir(self.home))
+                if os.path.isfile(join(self.home, name, INCOMPLETE_MARKER)))
+        for path, venv in candidates:
+            lock = self.package_lock(venv)
+            if lock.acquire(blocking=False):
+                lock.release()
+                abandoned.append(path)
+        return abandoned
+
+    @traced('gc')
+    def gc(self):
+        """Deletes the trash, links to uninstalled virtualenvs and
+        leftovers of crashed installs.  Returns the removed paths and
+        the bytes of shared files that were freed.
+        """
+        import shutil
+        removed = self.empty_trash()
+        with self.lock('bin'):
+            for path in self.find_orphaned_scripts():
+                os.remove(path)
+                removed.append(path)
+        for path in self.find_abandoned_builds():
+            venv = os.path.basename(path).split('+')[0]
+            with self.package_lock(venv):
+                if not os.path.exists(path):
+                    continue
+                if dirname(path) == self.home:
+                    if not os.path.isfile(join(path, INCOMPLETE_MARKER)):
+                        continue
+                    self.forget(venv)
+                shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+        return removed, self.store.collect()
+
+    @traced('dedupe')
+    def dedupe(self, venv_paths=None):
+        """Replaces identical files in the site-packages of the given
+        virtualenvs (or all of them) with hardlinks to a shared copy.
+        Returns the number of files linked and the bytes saved and freed.
+        """
+        prune = venv_paths is None
+        if prune:
+            venv_paths = [join(self.home, name) for name in
+                          sorted(os.listdir(self.home))
+                          if not name.startswith('.')] \
+                if os.path.isdir(self.home) else []
+        roots = [join(venv_path, lib) for venv_path in venv_paths
+                 for lib in ('lib', 'Lib')
+                 if os.path.isdir(join(venv_path, lib))]
+        linked, saved = self.store.dedupe(roots, prune=prune)
+        freed = self.store.collect() if prune else 0
+        return linked, saved, freed
+
+    def _dedupe_new(self, venv_path):
+        linked, saved, _ = self.dedupe([venv_path])
+        echo('  Hardlinked %d files, saved %s' % (linked, format_size(saved)))
+
+    def get_package_path(self, package):
+        return join(self.home, normalize_package(package))
+
+    def find_installed_executables(self, path):
+        prefix = join(realpath(normpath(path)), '')
+        try:
+            for filename in os.listdir(self.bin_dir):
+                exe = os.path.join(self.bin_dir, filename)
+                target = real_readlink(exe)
+                if target is None:
+                    continue
+                if target.startswith(prefix):
+                    yield exe
+        except OSError:
+            pass
+
+    def get_package_scripts(self, path):
+        """Get the scripts installed for PATH
+
+        Looks for package metadata listing which scripts were
+        installed. If there is no metadata (package was installed
+         with an older version of pipsi) then fall back to the old
+         find_installed_executables method.
+        """
+        packages = self.load_index()
+        info = packages.get(os.path.basename(path)) \
+            if packages is not None else None
+        if info is None:
+            info = self.get_package_info(path)
+        if 'scripts' in info:
             return info['scripts']
         # No script metadata - fall back to older method of searching for executables
         return self.find_installed_executables(path)
 
-    def link_scripts(self, scripts):
+    @traced('link scripts')
+    def link_scripts(self, scripts, venv_path=None, force=False):
+        """Links the scripts into the bin folder.  If `venv_path` is given
+        scripts that would replace ones of other packages are skipped unless
+        `force` is set.
+        """
+        conflicts = {}
+        if venv_path is not None:
+            conflicts = dict(self.find_conflicts(scripts, venv_path))
+        entry_points = {}
         rv = []
         for script in scripts:
             script_dst = os.path.join(
                 self.bin_dir, os.path.basename(script))
-            if publish_script(script, script_dst):
+            if script in conflicts:
+                owner = conflicts[script]
+                if not force:
+                    echo('  Not linking %s, it belongs to %s' % (
+                        script_dst, owner or 'another program'))
+                    continue
+                if owner is not None:
+                    self.disown(owner, script_dst)
+            launcher = None
+            if self.use_launchers:
+                venv = dirname(dirname(script))
+                if venv not in entry_points:
+                    entry_points[venv] = find_console_scripts(venv)
+                target = entry_points[venv].get(os.path.basename(script))
+                if target is not None:
+                    launcher = make_launcher(venv, target)
+            if launcher is not None:
+                if write_launcher(launcher, script_dst):
+                    rv.append((script, script_dst))
+            elif publish_script(script, script_dst):
                 rv.append((script, script_dst))
 
         return rv
 
-    def save_package_info(self, venv_path, package, scripts):
+    @traced('save package info')
+    def save_package_info(self, venv_path, package, scripts, python=None,
+                          source=None, editable=None):
         package_info_file_path = join(venv_path, 'package_info.json')
-        package_name = Requirement.parse(package).project_name
+        package_name = requirement_name(package)
         version = extract_package_version(venv_path, package_name)
+        try:
+            old_info = self.get_package_info(venv_path)
+        except (IOError, OSError, ValueError):
+            old_info = {}
 
         package_info = {
             'name': package_name,
             'version': version,
             'scripts': [script for target, script in scripts],
+            'python': python or old_info.get('python'),
+            'installed_at': old_info.get('installed_at') or time.time(),
+            'source': source or old_info.get('source'),
+            'editable': bool(old_info.get('editable')
+                             if editable is None else editable),
         }
-        with open(package_info_file_path, 'w') as fh:
-            json.dump(package_info, fh)
+        if old_info.get('slim'):
+            package_info['slim'] = old_info['slim']
+        write_json(package_info_file_path, package_info)
+        venv = os.path.basename(venv_path)
+        self._update_index(
+            lambda packages: packages.__setitem__(venv, package_info))
 
     def get_package_info(self, venv_path):
         package_info_file_path = join(venv_path, 'package_info.json')
         with open(package_info_file_path, 'r') as fh:
             return json.load(fh)
 
-    def install(self, package, python=None, editable=False, system_site_packages=False):
+    def load_index(self):
+        """Returns the package index, which maps virtualenv names to their
+        package info, or `None` if it was not created yet.
+        """
+        try:
+            with open(self.index_path, 'r') as fh:
+                return json.load(fh)['packages']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _iter_package_infos(self, wanted=None):
+        """Yields ``(venv, info)`` for the virtualenvs in the home folder,
+        sorted by name, reading the package info of only those for which
+        `wanted` returns true.
+        """
+        python = '/Scripts/python.exe' if IS_WIN else '/bin/python'
+        if not os.path.isdir(self.home):
+            return
+        for venv in sorted(os.listdir(self.home)):
+            if wanted is not None and not wanted(venv):
+                continue
+            venv_path = os.path.join(self.home, venv)
+            if os.path.isdir(venv_path) and \
+               os.path.isfile(venv_path + python):
+                try:
+                    yield venv, self.get_package_info(venv_path)
+                except (IOError, OSError, ValueError):
+                    # installed by an older pipsi
+                    yield venv, {}
+
+    def _scan_package_infos(self):
+        return dict(self._iter_package_infos())
+
+    def _update_index(self, func):
+        with self.lock('index'):
+            packages = self.load_index()
+            if packages is None:
+                packages = self._scan_package_infos()
+            func(packages)
+            if not os.path.isdir(self.home):
+                os.makedirs(self.home)
+            self._write_index(packages)
+
+    def _write_index(self, packages):
+        owners = {}
+        for venv, info in packages.items():
+            for script in info.get('scripts', []):
+                owners[os.path.basename(script)] = venv
+        write_json(self.index_path, {'packages': packages, 'owners': owners})
+
+    def reindex(self):
+        """Rebuilds the package index from the ``package_info.json`` files
+        of all virtualenvs and returns it.
+        """
+        with self.lock('index'):
+            packages = self._scan_package_infos()
+            if os.path.isdir(self.home):
+                self._write_index(packages)
+        return packages
+
+    def load_owners(self):
+        """Returns a dict mapping the names of the scripts in the bin
+        folder to the virtualenv that owns them.
+        """
+        try:
+            with open(self.index_path, 'r') as fh:
+                return json.load(fh)['owners']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        owners = {}
+        for venv, (scripts, _) in self.list_everything():
+            for script in scripts:
+                owners[os.path.basename(script)] = venv
+        return owners
+
+    def find_conflicts(self, scripts, venv_path, owners=None):
+        """Returns ``(script, owner)`` for every script that would replace
+        a file in the bin folder that does not belong to `venv_path`.  The
+        owner is the name of the other virtualenv or `None` if the file was
+        not installed through pipsi.
+        """
+        if owners is None:
+            owners = self.load_owners()
+        venv = os.path.basename(venv_path)
+        prefix = join(normalize(venv_path), '')
+        rv = []
+        for script in scripts:
+            name = os.path.basename(script)
+            owner = owners.get(name)
+            if owner == venv:
+                continue
+            dst = join(self.bin_dir, name)
+            if owner is None:
+                if not os.path.lexists(dst):
+                    continue
+                target = real_readlink(dst)
+                if target is not None and \
+                   normcase(target).startswith(prefix):
+                    continue
+            rv.append((script, owner))
+        return rv
+
+    def disown(self, owner, script):
+        """Removes a script from the package info of its old owner after
+        it was replaced by the script of another package.
+        """
+        venv_path = join(self.home, owner)
+        name = os.path.basename(script)
+
+        def _remove(info):
+            info['scripts'] = [x for x in info.get('scripts', [])
+                               if os.path.basename(x) != name]
+        try:
+            info = self.get_package_info(venv_path)
+        except (IOError, OSError, ValueError):
+            pass
+        else:
+            _remove(info)
+            write_json(join(venv_path, 'package_info.json'), info)
+        self._update_index(
+            lambda packages: _remove(packages.setdefault(owner, {})))
+
+    def forget(self, package):
+        """Removes a package from the package index."""
+        venv = os.path.basename(self.get_package_path(package))
+        self._update_index(lambda packages: packages.pop(venv, None))
+
+    def get_installed_version(self, venv_path, package):
+        packages = self.load_index() or {}
+        info = packages.get(os.path.basename(venv_path))
+        if info is None:
+            try:
+                info = self.get_package_info(venv_path)
+            except (IOError, OSError, ValueError):
+                info = {}
+        return info.get('version') or \
+            extract_package_version(venv_path, package)
+
+    def available_versions(self, venv_path, package):
+        """Returns the versions of `package` available from the wheelhouse
+        and the package index pip of the virtualenv is configured for, or
+        `None` if they cannot be determined.
+        """
+        import glob
+        versions = []
+        if self.use_wheelhouse:
+            wanted = re.sub(r'[-_.]+', '_', package).lower()
+            for filename in glob.glob(join(self.wheelhouse.path, '*.whl')):
+                parts = os.path.basename(filename).split('-')
+                if parts[0].lower() == wanted:
+                    versions.append(parts[1])
+
+        args = [join(venv_path, BIN_DIR, 'python'), '-m', 'pip']
+        if find_distribution(venv_path, 'pip') is None:
+            # `slim` removed pip.  Ask the one pipsi runs with instead of
+            # installing it again only to find out there is nothing to do.
+            version = get_virtualenv_python_version(venv_path)
+            if version is None:
+                return None
+            args = [sys.executable, '-m', 'pip', 'index', 'versions',
+                    '--python-version', '%d.%d' % version, package]
+        else:
+            args += ['index', 'versions', package]
+        r = run(args)
+        if r.returncode != 0:
+            debugp('Could not list versions of {}: {}'.format(
+                package, r.stderr))
+            return None
+        for line in r.stdout.splitlines():
+            if line.strip().startswith('Available versions:'):
+                versions.extend(v.strip() for v in
+                                line.split(':', 1)[1].split(','))
+        return versions
+
+    @traced('check version')
+    def get_up_to_date_version(self, venv_path, spec):
+        """Returns the installed version if it satisfies `spec` and no newer
+        version satisfying it is available, otherwise `None`.
+        """
+        name = requirement_name(spec)
+        try:
+            specifier, parse_version = parse_specifier(spec)
+        except ImportError:
+            # cannot tell, let pip decide
+            return None
+        version = self.get_installed_version(venv_path, name)
+        if not version or not specifier.contains(version, prereleases=True):
+            return None
+        try:
+            available = self.available_versions(venv_path, name)
+        except OSError:
+            return None
+        if available is None:
+            return None
+        candidates = [parse_version(v) for v in specifier.filter(available)]
+        if candidates and max(candidates) > parse_version(version):
+            return None
+        return version
+
+    def get_template(self, real_python, python_semver):
+        """Returns the path to the pristine template virtualenv for the
+        given interpreter, creating it if necessary.  If the template is
+        stale because the interpreter changed since it was created it is
+        discarded and `None` is returned so that the caller falls back to
+        creating the virtualenv from scratch.
+        """
+        import hashlib
+        import shutil
+        import tempfile
+        key = 'python%d.%d.%d-%s' % (python_semver + (hashlib.sha1(
+            realpath(real_python).encode('utf-8')).hexdigest()[:10],))
+        templates_dir = join(self.home, '.templates')
+        template = join(templates_dir, key)
+        stamp = interpreter_stamp(real_python)
+
+        with self._template_lock:
+            try:
+                with open(join(template, TEMPLATE_INFO)) as fh:
+                    info = json.load(fh)
+            except (IOError, OSError, ValueError):
+                info = None
+            if info is not None:
+                if info.get('stamp') == stamp and \
+                   os.path.exists(join(template, BIN_DIR, 'python')):
+                    return template
+                debugp('Discarding stale template {}'.format(template))
+                shutil.rmtree(template, ignore_errors=True)
+                return None
+
+            if not os.path.isdir(templates_dir):
+                os.makedirs(templates_dir)
+            tmp = tempfile.mkdtemp(prefix='.tmp-', dir=templates_dir)
+            try:
+                if call([real_python, '-m', 'venv', tmp]) != 0:
+                    return None
+                relocate_virtualenv(tmp, tmp, template)
+                write_json(join(tmp, TEMPLATE_INFO), {
+                    'python': realpath(real_python),
+                    'version': '.'.join(map(str, python_semver)),
+                    'stamp': stamp,
+                })
+                os.rename(tmp, template)
+            except OSError:
+                # Another pipsi process might have created it meanwhile
+                if not os.path.isdir(template):
+                    return None
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        return template
+
+    @traced('create virtualenv')
+    def create_virtualenv(self, venv_path, python, python_semver,
+                          system_site_packages=False):
+        """Creates a fresh virtualenv for the given interpreter.  For
+        Python 3 it is cloned from a template virtualenv when possible,
+        which saves running `venv` and bootstrapping pip every time.
+        """
+        if python_semver[0] == 3:
+            # if target python is 3, use its builtin `venv` module to create virtualenv
+            real_python = self.pythons.probe(python)['real_python']
+            if self.use_templates and not system_site_packages and \
+               not IS_WIN:
+                template = self.get_template(real_python, python_semver)
+                if template is not None:
+                    debugp('Cloning {} from {}'.format(venv_path, template))
+                    clone_virtualenv(template, venv_path)
+                    return True
+            args = [real_python, '-m', 'venv', venv_path]
+        else:
+            # Install virtualenv, use the pipsi used python version by default
+            args = [sys.executable, '-m', 'virtualenv', '-p', python, venv_path]
+
+        if system_site_packages:
+            args.append('--system-site-packages')
+        return call(args) == 0
+
+    @traced('pip install')
+    def pip_install(self, venv_path, install_args, editable=False,
+                    upgrade=False, byte_compile=True):
+        """Runs pip of the virtualenv to install `install_args`.  With the
+        wheelhouse enabled all wheels are built (or reused from the
+        wheelhouse) first, stored in the wheelhouse and then installed
+        without touching the index again.
+        """
+        import glob
+        import shutil
+        import tempfile
+        python = join(venv_path, BIN_DIR, 'python')
+        if not self._ensure_pip(venv_path):
+            return False
+        args = [python, '-m', 'pip', 'install']
+        if upgrade:
+            args.append('--upgrade')
+        if not byte_compile:
+            args.append('--no-compile')
+        if not self.use_wheelhouse:
+            if editable:
+                args.append('--editable')
+            return call(args + install_args) == 0
+
+        wheelhouse = self.wheelhouse
+        if not os.path.isdir(wheelhouse.path):
+            try:
+                os.makedirs(wheelhouse.path)
+            except OSError:
+                if not os.path.isdir(wheelhouse.path):
+                    raise
+        if editable:
+            # Editable installs cannot go through a wheel, but their
+            # dependencies can still be picked up from the wheelhouse.
+            return call(args + ['--find-links', wheelhouse.path,
+                                '--editable'] + install_args) == 0
+
+        wheel_dir = tempfile.mkdtemp(prefix='.build-', dir=wheelhouse.path)
+        try:
+            if call([python, '-m', 'pip', 'wheel',
+                     '--wheel-dir', wheel_dir,
+                     '--find-links', wheelhouse.path] + install_args) != 0:
+                return False
+            wheelhouse.add(wheel_dir)
+            wheels = sorted(glob.glob(join(wheel_dir, '*.whl')))
+            if call(args + ['--no-index', '--find-links', wheel_dir] +
+                    wheels) != 0:
+                return False
+        finally:
+            shutil.rmtree(wheel_dir, ignore_errors=True)
+        wheelhouse.prune()
+        return True
+
+    def install(self, package, python=None, editable=False, system_site_packages=False,
+                force=False, slim=False):
         # `python` could be int as major version, or str as absolute bin path,
         # if it's int, then we will try to find the executable `python2` or `python3` in PATH
         if isinstance(python, int):
-            python_exe = 'python{}'.format(python)
-            python = distutils.spawn.find_executable(python_exe)
-            if not python:
-                raise ValueError('Can not find {} in PATH'.format(python_exe))
+            python = self.pythons.find(python)
         if not python:
             python = sys.executable
-        python_semver = get_python_semver(python)
+        python_semver = tuple(self.pythons.probe(python)['version'])
         debugp('python: {}, python_bin_semver: {}'.format(python, python_semver))
 
         package, install_args = self.resolve_package(package, python)
 
         venv_path = self.get_package_path(package)
+        with span('install', package=package):
+            with self.package_lock(os.path.basename(venv_path)):
+                rv = self._install(package, install_args, venv_path,
+                                   python, python_semver, editable,
+                                   system_site_packages, force)
+                if rv and slim:
+                    self._slim(venv_path, DEFAULT_SLIM_CLASSES)
+                return rv
+
+    def _build_virtualenv(self, staging, install_args, python, python_semver,
+                          editable, system_site_packages):
+        if not self.create_virtualenv(staging, python, python_semver,
+                                      system_site_packages):
+            echo('Failed to create virtualenv.  Aborting.')
+            return None
+        if not self.pip_install(staging, install_args, editable,
+                                byte_compile=False):
+            echo('Failed to pip install.  Aborting.')
+            return None
+        return staging
+
+    def _make_staging(self, venv):
+        """Removes leftovers of crashed builds of a virtualenv and returns
+        a fresh path to build it in.  The lock of the package needs to be
+        held.
+        """
+        import glob
+        import shutil
+        import tempfile
+        staging_dir = join(self.home, '.staging')
+        # As we hold the lock nobody else can be working on them
+        for stale in glob.glob(join(staging_dir, venv + '+*')):
+            echo('Removing incomplete build %s' % stale)
+            shutil.rmtree(stale, ignore_errors=True)
+
+        for path in (self.bin_dir, staging_dir):
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # another install of the same batch might have won
+                    if not os.path.isdir(path):
+                        raise
+
+        staging = tempfile.mkdtemp(prefix=venv + '+', dir=staging_dir)
+        os.rmdir(staging)
+        return staging
+
+    def _install(self, package, install_args, venv_path, python,
+                 python_semver, editable, system_site_packages, force):
+        def _build(staging):
+            return self._build_virtualenv(staging, install_args, python,
+                                          python_semver, editable,
+                                          system_site_packages)
+
+        # Remember where the package came from so it can be installed
+        # the same way again.
+        source = install_args[0]
+        if os.path.isdir(source):
+            source = os.path.abspath(source)
+        return self._install_staged(package, venv_path, _build, force,
+                                    python=python, source=source,
+                                    editable=editable)
+
+    def _install_staged(self, package, venv_path, build, force,
+                        scripts=None, python=None, source=None,
+                        editable=None):
+        """Installs `package` into `venv_path` with the lock of the package
+        held.  `build` is called with a staging folder to create the
+        virtualenv in and returns the path the virtualenv refers to itself
+        by, or `None` if that failed.  The virtualenv is then moved into
+        place and its scripts (`scripts` relative to the virtualenv, or
+        the ones of the package) are linked.
+        """
+        import shutil
+        if os.path.isfile(join(venv_path, INCOMPLETE_MARKER)):
+            echo('Removing incomplete installation of %s' % package)
+            shutil.rmtree(venv_path)
+            self.forget(package)
+
         if os.path.isdir(venv_path):
-            click.echo('%s is already installed' % package)
+            echo('%s is already installed' % package)
             return
 
-        if not os.path.exists(self.bin_dir):
-            os.makedirs(self.bin_dir)
-
-        from subprocess import Popen
+        # The virtualenv is built in a staging folder and only moved into
+        # place once pip succeeded, so nobody ever sees a half-built one.
+        staging = self._make_staging(os.path.basename(venv_path))
 
         def _cleanup():
-            try:
-                shutil.rmtree(venv_path)
-            except (OSError, IOError):
-                pass
+            for path in (staging, venv_path):
+                try:
+                    shutil.rmtree(path)
+                except (OSError, IOError):
+                    pass
+            self.forget(package)
             return False
 
-        # Install virtualenv, use the pipsi used python version by default
-        args = [sys.executable, '-m', 'virtualenv', '-p', python, venv_path]
-
-        if python_semver[0] == 3:
-            # if target python is 3, use its builtin `venv` module to create virtualenv
-            real_python = get_real_python(python)
-            args = [real_python, '-m', 'venv', venv_path]
-
-        if system_site_packages:
-            args.append('--system-site-packages')
-
         try:
-            debugp('Popen: {}'.format(args))
-            if Popen(args).wait() != 0:
-                click.echo('Failed to create virtualenv.  Aborting.')
+            built_for = build(staging)
+            if built_for is None:
                 return _cleanup()
 
-            args = [os.path.join(venv_path, BIN_DIR, 'python'), '-m', 'pip', 'install']
-            if editable:
-                args.append('--editable')
-
-            debugp('Popen: {}'.format(args + install_args))
-            if Popen(args + install_args).wait() != 0:
-                click.echo('Failed to pip install.  Aborting.')
-                return _cleanup()
+            open(join(staging, INCOMPLETE_MARKER), 'w').close()
+            relocate_virtualenv(staging, built_for, venv_path)
+            os.rename(staging, venv_path)
+            compile_virtualenv(venv_path)
         except Exception:
             _cleanup()
             raise
 
         # Find all the scripts
-        scripts = find_scripts(venv_path, package)
+        if scripts is None:
+            scripts = find_scripts(venv_path, package)
+        else:
+            scripts = [join(venv_path, script) for script in scripts]
+
+        with self.lock('bin'):
+            # Refuse to replace scripts of other packages
+            conflicts = self.find_conflicts(scripts, venv_path)
+            if conflicts and not force:
+                for script, owner in conflicts:
+                    echo('%s already exists and belongs to %s.' % (
+                        os.path.join(self.bin_dir, os.path.basename(script)),
+                        owner or 'another program'))
+                echo('Use --force to replace it.  Aborting.')
+                return _cleanup()
 
-        # And link them
-        linked_scripts = self.link_scripts(scripts)
+            # And link them
+            linked_scripts = self.link_scripts(scripts, venv_path, force=True)
 
-        self.save_package_info(venv_path, package, linked_scripts)
+        self.save_package_info(venv_path, package, linked_scripts, python,
+                               source, editable)
 
         # We did not link any, rollback.
         if not linked_scripts:
-            click.echo('Did not find any scripts.  Uninstalling.')
+            echo('Did not find any scripts.  Uninstalling.')
             return _cleanup()
+        os.remove(join(venv_path, INCOMPLETE_MARKER))
+
+        if self.auto_dedupe:
+            self._dedupe_new(venv_path)
         return True
 
+    def find_stale_virtualenvs(self, python_version=None):
+        """Returns the names of the virtualenvs whose interpreter is gone
+        or, if `python_version` is given, is of another ``(major, minor)``
+        version.  Interpreters are not started for this.
+        """
+        rv = []
+        python = join(BIN_DIR, 'python.exe' if IS_WIN else 'python')
+        venvs = sorted(os.listdir(self.home)) \
+            if os.path.isdir(self.home) else []
+        for venv in venvs:
+            venv_path = join(self.home, venv)
+            # The index leaves out virtualenvs with a dangling interpreter
+            if venv.startswith('.') or \
+               not os.path.lexists(join(venv_path, python)) or \
+               os.path.isfile(join(venv_path, INCOMPLETE_MARKER)):
+                continue
+            if not has_working_interpreter(venv_path) or (
+                    python_version is not None and
+                    get_virtualenv_python_version(venv_path) !=
+                    tuple(python_version[:2])):
+                rv.append(venv)
+        return rv
+
+    def reinstall(self, package, python=None, force=False):
+        """Builds the virtualenv of an installed package again from the
+        spec it was installed with, with `python` or the interpreter it
+        was installed with.  The new virtualenv is built next to the old
+        one which is only replaced once the scripts can be linked.
+        """
+        if isinstance(python, int):
+            python = self.pythons.find(python)
+        venv_path = self.get_package_path(package)
+        with span('reinstall', package=package):
+            with self.package_lock(os.path.basename(venv_path)):
+                return self._reinstall(package, venv_path, python, force)
+
+    def _reinstall(self, package, venv_path, python, force):
+        import shutil
+        if not os.path.isdir(venv_path) or \
+           os.path.isfile(join(venv_path, INCOMPLETE_MARKER)):
+            echo('%s is not installed' % package)
+            return
+        try:
+            info = self.get_package_info(venv_path)
+        except (IOError, OSError, ValueError):
+            info = {}
+        name = info.get('name') or package
+        spec = info.get('source') or name
+        editable = bool(info.get('editable'))
+        if not python:
+            try:
+                python = locate_python(info.get('python') or '')
+            except ValueError:
+                python = sys.executable
+        python_semver = tuple(self.pythons.probe(python)['version'])
+        _, install_args = self.resolve_package(spec, python)
+        system_site_packages = read_pyvenv_cfg(venv_path).get(
+            'include-system-site-packages') == 'true'
+        old_scripts = set(self.get_package_scripts(venv_path))
+
+        staging = self._make_staging(os.path.basename(venv_path))
+        trashed = None
+        try:
+            if self._build_virtualenv(staging, install_args, python,
+                                      python_semver, editable,
+                                      system_site_packages) is None:
+                shutil.rmtree(staging, ignore_errors=True)
+                return False
+            relocate_virtualenv(staging, staging, venv_path)
+            scripts = [join(venv_path, os.path.relpath(script, staging))
+                       for script in find_scripts(staging, name)]
+
+            with self.lock('bin'):
+                conflicts = self.find_conflicts(scripts, venv_path)
+                if conflicts and not force:
+                    for script, owner in conflicts:
+                        echo('%s already exists and belongs to %s.' % (
+                            join(self.bin_dir, os.path.basename(script)),
+                            owner or 'another program'))
+                    echo('Use --force to replace it.  Aborting.')
+                    shutil.rmtree(staging, ignore_errors=True)
+                    return False
+
+                trashed = join(self.trash(venv_path),
+                               os.path.basename(venv_path))
+                os.rename(staging, venv_path)
+                linked_scripts = self.link_scripts(scripts, venv_path,
+                                                   force=True)
+                if not linked_scripts:
+                    echo('Did not find any scripts.  Keeping the old '
+                         'virtualenv.')
+                    shutil.rmtree(venv_path)
+                    os.rename(trashed, venv_path)
+                    trashed = None
+                    return False
+
+                for script in old_scripts - set(
+                        script for target, script in linked_scripts):
+                    echo('  Removing old script %s' % script)
+                    try:
+                        os.remove(script)
+                    except OSError:
+                        pass
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            if trashed is not None and os.path.isdir(trashed):
+                shutil.rmtree(venv_path, ignore_errors=True)
+                os.rename(trashed, venv_path)
+            raise
+
+        self.empty_trash([dirname(trashed)], background=True)
+        compile_virtualenv(venv_path)
+        self.save_package_info(venv_path, name, linked_scripts, python,
+                               spec, editable)
+        if info.get('slim'):
+            self._slim(venv_path, info['slim'])
+        if self.auto_dedupe:
+            self._dedupe_new(venv_path)
+        return True
+
+    def bundle(self, package, fileobj):
+        """Writes the virtualenv of an installed package together with its
+        package info and scripts as a compressed tar stream to `fileobj`.
+        Returns `None` if the package is not installed and `False` if it
+        cannot be bundled.
+        """
+        import io
+        import tarfile
+        venv_path = self.get_package_path(package)
+        with self.package_lock(os.path.basename(venv_path)):
+            if not os.path.isdir(venv_path) or \
+               os.path.isfile(join(venv_path, INCOMPLETE_MARKER)):
+                echo('%s is not installed' % package)
+                return
+            try:
+                info = self.get_package_info(venv_path)
+            except (IOError, OSError, ValueError):
+                info = {}
+            if info.get('editable'):
+                echo('%s is installed in editable mode and cannot be '
+                     'bundled' % package)
+                return False
+
+            name = info.get('name') or package
+            linked = set(os.path.basename(script)
+                         for script in info.get('scripts') or ())
+            scripts = [os.path.relpath(script, venv_path)
+                       for script in find_scripts(venv_path, name)
+                       if not linked or os.path.basename(script) in linked]
+            data = json.dumps({
+                'package': name,
+                'path': venv_path,
+                'python_version': list(get_python_semver(
+                    join(venv_path, BIN_DIR, 'python'))),
+                'package_info': info,
+                'scripts': scripts,
+            }, indent=2).encode('utf-8')
+
+            def _filter(member):
+                if os.path.basename(member.name) != INCOMPLETE_MARKER:
+                    return member
+
+            with span('bundle', package=package):
+                tar = tarfile.open(fileobj=fileobj, mode='w|gz')
+                try:
+                    member = tarfile.TarInfo(BUNDLE_INFO)
+                    member.size = len(data)
+                    member.mtime = time.time()
+                    tar.addfile(member, io.BytesIO(data))
+                    tar.add(venv_path, arcname='venv', filter=_filter)
+                finally:
+                    tar.close()
+            return True
+
+    def install_bundle(self, fileobj, force=False):
+        """Installs a package from a bundle written by `bundle`, reading it
+        from `fileobj` as a stream.  The bundle can only be installed with
+        an interpreter of the same version at the same place as the one it
+        was built with.
+        """
+        import tarfile
+        tar = tarfile.open(fileobj=fileobj, mode='r|gz')
+        try:
+            member = tar.next()
+            if member is None or member.name != BUNDLE_INFO:
+                raise click.UsageError('%s is not a pipsi bundle' % getattr(
+                    fileobj, 'name', 'The input'))
+            info = json.loads(tar.extractfile(member).read().decode('utf-8'))
+            package = info['package']
+            package_info = info.get('package_info') or {}
+
+            def _build(staging):
+                extract_bundle(tar, staging)
+                python = join(staging, BIN_DIR, 'python')
+                wanted = '.'.join(map(str, info['python_version']))
+                if not os.path.exists(python):
+                    echo('The bundle needs Python %s at %s.  Aborting.' % (
+                        wanted, real_readlink(python) or python))
+                    return None
+                version = get_python_semver(python)
+                if list(version[:2]) != info['python_version'][:2]:
+                    echo('The bundle was built with Python %s but the '
+                         'interpreter is Python %s.  Aborting.' % (
+                             wanted, '.'.join(map(str, version))))
+                    return None
+                return info['path']
+
+            venv_path = self.get_package_path(package)
+            with span('install', package=package):
+                with self.package_lock(os.path.basename(venv_path)):
+                    return self._install_staged(
+                        package, venv_path, _build, force,
+                        scripts=info['scripts'],
+                        python=package_info.get('python'),
+                        source=package_info.get('source'), editable=False)
+        finally:
+            tar.close()
+
     def uninstall(self, package):
         path = self.get_package_path(package)
         if not os.path.isdir(path):
             return UninstallInfo(package, installed=False)
         paths = [path]
         paths.extend(self.get_package_scripts(path))
-        return UninstallInfo(package, paths)
+        return UninstallInfo(package, paths, repo=self)
 
-    def upgrade(self, package, editable=False):
+    def upgrade(self, package, editable=False, force=False, check=True):
+        spec = package
         package, install_args = self.resolve_package(package)
 
         venv_path = self.get_package_path(package)
-        if not os.path.isdir(venv_path):
-            click.echo('%s is not installed' % package)
+        with span('upgrade', package=package):
+            with self.package_lock(os.path.basename(venv_path)):
+                return self._upgrade(package, spec, install_args, venv_path,
+                                     editable, force, check)
+
+    def upgrade_from_index(self, venv, force=False, check=True):
+        """Upgrades an installed package from the package index by the
+        name of its virtualenv.  Unlike `upgrade` a folder of that name in
+        the working directory is never mistaken for the package.
+        """
+        venv_path = self.get_package_path(venv)
+        with span('upgrade', package=venv):
+            with self.package_lock(os.path.basename(venv_path)):
+                return self._upgrade(venv, venv, [venv], venv_path, False,
+                                     force, check)
+
+    def _upgrade(self, package, spec, install_args, venv_path, editable,
+                 force, check):
+        if not os.path.isdir(venv_path) or \
+           os.path.isfile(join(venv_path, INCOMPLETE_MARKER)):
+            echo('%s is not installed' % package)
             return
 
-        from subprocess import Popen
+        # Local packages and URLs are always reinstalled, for everything
+        # else check first whether there is anything to do.
+        if check and not editable and install_args == [spec]:
+            version = self.get_up_to_date_version(venv_path, spec)
+            if version is not None:
+                echo('%s is up to date (%s)' % (package, version))
+                return True
 
         old_scripts = set(self.get_package_scripts(venv_path))
 
-        args = [os.path.join(venv_path, BIN_DIR, 'python'), '-m', 'pip', 'install',
-                '--upgrade']
-        if editable:
-            args.append('--editable')
-
-        if Popen(args + install_args).wait() != 0:
-            click.echo('Failed to upgrade through pip.  Aborting.')
+        if not self.pip_install(venv_path, install_args, editable,
+                                upgrade=True, byte_compile=False):
+            echo('Failed to upgrade through pip.  Aborting.')
+            # pip might have been restored for this
+            self._reslim(venv_path)
             return
+        compile_virtualenv(venv_path)
 
         scripts = find_scripts(venv_path, package)
-        linked_scripts = self.link_scripts(scripts)
-        to_delete = old_scripts - set(script for target, script in linked_scripts)
+        with self.lock('bin'):
+            linked_scripts = self.link_scripts(scripts, venv_path, force)
+            to_delete = old_scripts - set(
+                script for target, script in linked_scripts)
+
+            for script in to_delete:
+                try:
+                    echo('  Removing old script %s' % script)
+                    os.remove(script)
+                except (IOError, OSError):
+                    pass
+
+        self.save_package_info(venv_path, package, linked_scripts,
+                               editable=editable)
+        self._reslim(venv_path)
+
+        if self.auto_dedupe:
+            self._dedupe_new(venv_path)
+        return True
+
+    def compile(self, package, optimize=None):
+        """Byte-compiles the virtualenv of an installed package.  Returns
+        `None` if it is not installed.
+        """
+        venv_path = self.get_package_path(package)
+        with self.package_lock(os.path.basename(venv_path)):
+            if not os.path.isdir(venv_path) or \
+               os.path.isfile(join(venv_path, INCOMPLETE_MARKER)):
+                echo('%s is not installed' % package)
+                return
+            return compile_virtualenv(venv_path, optimize)
+
+    def slim(self, package, classes=None):
+        """Removes the files of the given classes (by default
+        `DEFAULT_SLIM_CLASSES`) from the virtualenv of an installed
+        package.  They are removed again after every upgrade.  Returns the
+        number of files removed and their size, or `None` if the package
+        is not installed.
+        """
+        venv_path = self.get_package_path(package)
+        with self.package_lock(os.path.basename(venv_path)):
+            if not os.path.isdir(venv_path) or \
+               os.path.isfile(join(venv_path, INCOMPLETE_MARKER)):
+                echo('%s is not installed' % package)
+                return
+            return self._slim(venv_path, classes or DEFAULT_SLIM_CLASSES)
+
+    def _slim(self, venv_path, classes):
+        rv = slim_virtualenv(venv_path, classes)
+        try:
+            info = self.get_package_info(venv_path)
+        except (IOError, OSError, ValueError):
+            return rv
+        info['slim'] = sorted(set(classes) | set(info.get('slim') or ()))
+        write_json(join(venv_path, 'package_info.json'), info)
+        venv = os.path.basename(venv_path)
+        self._update_index(lambda packages: packages.__setitem__(venv, info))
+        return rv
 
-        for script in to_delete:
+    def _ensure_pip(self, venv_path):
+        """Installs pip into a virtualenv again if `slim` removed it.  This
+        is only done right before pip installs something, which is always
+        followed by slimming the virtualenv again.
+        """
+        if find_distribution(venv_path, 'pip') is not None:
+            return True
+        try:
+            if not self.get_package_info(venv_path).get('slim'):
+                return True
+        except (IOError, OSError, ValueError):
+            return True
+        echo('Restoring pip')
+        if call([join(venv_path, BIN_DIR, 'python'), '-m', 'ensurepip',
+                 '--default-pip']) != 0:
+            echo('Could not restore pip.  Reinstall the package instead.')
+            return False
+        return True
+
+    def _reslim(self, venv_path):
+        try:
+            classes = self.get_package_info(venv_path).get('slim')
+        except (IOError, OSError, ValueError):
+            return
+        if classes:
+            self._slim(venv_path, classes)
+
+    def freeze(self):
+        """Returns a manifest entry for every installed package.  Packages
+        installed from an index are pinned to their installed version,
+        local packages and URLs are referenced as they were installed.
+        """
+        packages = self.load_index()
+        if packages is None:
+            packages = self.reindex()
+        entries = []
+        for venv, info in sorted(packages.items()):
+            name = info.get('name') or venv
+            version = info.get('version')
+            source = info.get('source') or name
+            pinned = version and not (
+                os.path.isabs(source) or urlparse(source).netloc)
+            entries.append({
+                'name': name,
+                'version': version,
+                'spec': '%s==%s' % (name, version) if pinned else source,
+                'python': info.get('python'),
+                'editable': bool(info.get('editable')),
+                'source': source,
+            })
+        return entries
+
+    def plan_sync(self, entries):
+        """Works out what needs to change so that the installed packages
+        match the given manifest entries.  Returns a list of ``(action,
+        name, entry)`` tuples where action is one of ``install``,
+        ``upgrade``, ``replace`` and ``uninstall``.  Packages that need to
+        become editable or stop being editable are replaced, as pip cannot
+        upgrade them into that.  Only the package index is read.
+        """
+        packages = self.load_index()
+        if packages is None:
+            packages = self.reindex()
+        plan = []
+        wanted = set()
+        for entry in entries:
+            venv = normalize_package(entry['name'])
+            wanted.add(venv)
+            info = packages.get(venv)
+            if info is None:
+                plan.append(('install', entry['name'], entry))
+            elif bool(info.get('editable')) != bool(entry.get('editable')):
+                plan.append(('replace', entry['name'], entry))
+            elif (entry.get('version') and
+                  info.get('version') != entry['version']):
+                plan.append(('upgrade', entry['name'], entry))
+        for venv in sorted(packages):
+            if venv not in wanted:
+                plan.append(('uninstall', venv, None))
+        return plan
+
+    def _describe(self, result, venv_path):
+        try:
+            info = self.get_package_info(venv_path)
+        except (IOError, OSError, ValueError):
+            return
+        result.version = info.get('version')
+        result.scripts = info.get('scripts', [])
+
+    def install_many(self, specs, python=None, editable=False,
+                     system_site_packages=False, force=False, slim=False,
+                     jobs=1, progress=None):
+        """Installs every spec into its own virtualenv like `install` and
+        returns a `PackageResult` for each.  See `run_packages` for
+        `jobs` and `progress`.
+        """
+        def _install(result):
+            rv = self.install(result.spec, python, editable,
+                              system_site_packages, force, slim)
+            result.package = normalize_package(
+                self.resolve_package(result.spec)[0])
+            result.status = {True: 'installed',
+                             None: 'already-installed'}.get(rv, 'failed')
+            if rv is not False:
+                self._describe(result,
+                               self.get_package_path(result.package))
+        return run_packages(_install, specs, jobs, progress)
+
+    def upgrade_many(self, specs, editable=False, force=False, jobs=1,
+                     progress=None):
+        """Upgrades installed packages like `upgrade` and returns a
+        `PackageResult` for each.  Packages whose version did not change
+        are reported as ``'up-to-date'``.
+        """
+        def _upgrade(result):
+            result.package = normalize_package(
+                self.resolve_package(result.spec)[0])
+            venv_path = self.get_package_path(result.package)
+            if not os.path.isdir(venv_path):
+                echo('%s is not installed' % result.package)
+                result.status = 'not-installed'
+                return
+            self._describe(result, venv_path)
+            old_version = result.version
+            if not self.upgrade(result.spec, editable, force):
+                result.status = 'failed'
+                return
+            self._describe(result, venv_path)
+            if old_version is not None and old_version == result.version:
+                result.status = 'up-to-date'
+            else:
+                result.status = 'upgraded'
+        return run_packages(_upgrade, specs, jobs, progress)
+
+    def uninstall_many(self, packages, jobs=1, progress=None):
+        """Uninstalls packages and returns a `PackageResult` for each with
+        the version and scripts the package had.
+        """
+        def _uninstall(result):
+            result.package = normalize_package(result.spec)
+            uinfo = self.uninstall(result.package)
+            if not uinfo.installed:
+                echo('%s is not installed' % result.package)
+                result.status = 'not-installed'
+                return
+            self._describe(result, self.get_package_path(result.package))
+            uinfo.perform()
+            result.status = 'uninstalled'
+        return run_packages(_uninstall, packages, jobs, progress)
+
+    def iter_packages(self, packages=None, scripts=None):
+        """Yields ``(venv, info)`` for the installed packages sorted by
+        name, as soon as each one is read.  `packages` and `scripts` are
+        glob patterns the names of the packages and of their scripts need
+        to match.  Without a package index, only the package infos of the
+        virtualenvs matching `packages` are read.
+        """
+        from fnmatch import fnmatchcase
+        packages = [pattern.lower() for pattern in packages or ()]
+        scripts = list(scripts or ())
+
+        def _wanted(venv):
+            return not packages or \
+                any(fnmatchcase(venv, pattern) for pattern in packages)
+
+        def _has_scripts(names):
+            return not scripts or any(
+                fnmatchcase(os.path.basename(name), pattern)
+                for name in names for pattern in scripts)
+
+        index = self.load_index()
+        if index is not None:
+            for venv in sorted(index):
+                info = index[venv]
+                if _wanted(venv) and _has_scripts(info.get('scripts', [])):
+                    yield venv, info
+            return
+
+        # Without an index every package info is read, which is a good
+        # opportunity to write the index unless only some were wanted.
+        found = {}
+        for venv, info in self._iter_package_infos(
+                _wanted if packages else None):
+            found[venv] = info
+            if _has_scripts(info.get('scripts', [])):
+                yield venv, info
+        if not packages and os.path.isdir(self.home):
             try:
-                click.echo('  Removing old script %s' % script)
-                os.remove(script)
+                with self.lock('index'):
+                    self._write_index(found)
             except (IOError, OSError):
+                # read-only home, just do without the index
                 pass
 
-        self.save_package_info(venv_path, package, linked_scripts)
+    def list_everything(self, versions=False):
+        return [(venv, [info.get('scripts', []),
+                        info.get('version') if versions else None])
+                for venv, info in self.iter_packages()]
 
-        return True
 
-    def list_everything(self, versions=False):
-        venvs = {}
-        python = '/Scripts/python.exe' if IS_WIN else '/bin/python'
-        if os.path.isdir(self.home):
-            for venv in os.listdir(self.home):
-                venv_path = os.path.join(self.home, venv)
-                if os.path.isdir(venv_path) and \
-                   os.path.isfile(venv_path + python):
-                    info = self.get_package_info(venv_path)
-                    version = None
-                    if versions:
-                        version = info.get('version')
-                    venvs[venv] = [info.get('scripts', []), version]
+def print_timings():
+    summary = tracer.summary()
+    if not summary:
+        return
+    click.echo()
+    click.echo('Timings:')
+    width = max(len(name) for name, _, _ in summary)
+    for name, count, seconds in summary:
+        click.echo('  %-*s %5dx %9.3fs' % (width, name, count, seconds))
+
+
+BatchResult = namedtuple('BatchResult', ('package', 'ok', 'error'))
 
-        return sorted(venvs.items())
+
+def run_batch(func, packages, jobs=1):
+    """Calls `func` for every package, up to `jobs` of them at the same
+    time, on top of `run_packages`.  A failing package does not abort the
+    others.  With one job the output is printed as it arrives, with more
+    the output of every package is printed as one group prefixed with the
+    package name once it finishes.
+
+    Returns a list of `BatchResult` in the order of `packages`.
+    """
+    packages = list(packages)
+    jobs = max(1, min(jobs, len(packages)))
+
+    def work(result):
+        result.package = result.spec
+        try:
+            ok = func(result.spec)
+        except Exception as e:
+            if len(packages) > 1:
+                raise
+            # re-raised below without the error message in the output
+            result.error = e
+            ok = False
+        result.status = 'done' if ok else 'failed'
+
+    def progress(event, result):
+        if event == 'output' and jobs == 1:
+            click.echo(result.log[-1])
+        elif event == 'finished' and jobs > 1:
+            for line in result.log:
+                click.echo('[%s] %s' % (result.package, line))
+
+    results = run_packages(work, packages, jobs, progress)
+    if len(packages) == 1 and results[0].error is not None:
+        raise results[0].error
+    return [BatchResult(r.spec, r.status != 'failed', r.error)
+            for r in results]
+
+
+def finish_batch(results, done='Done.'):
+    """Reports the outcome of `run_batch` and exits with a non-zero status
+    if any package failed.
+    """
+    if len(results) > 1:
+        click.echo()
+        click.echo('Summary:')
+        for result in results:
+            click.echo('  %s: %s' % (
+                result.package, 'ok' if result.ok else 'failed'))
+    if not all(result.ok for result in results):
+        sys.exit(1)
+    click.echo(done)
 
 
 @click.group(context_settings=CONTEXT_SETTINGS)
@@ -450,18 +2980,63 @@ class Repo(object):
     envvar='PIPSI_BIN_DIR',
     default=os.path.join(os.path.expanduser('~'), '.local', 'bin'),
     help='The path where the scripts are symlinked to.')
+@click.option(
+    '--wheelhouse/--no-wheelhouse', envvar='PIPSI_WHEELHOUSE', default=False,
+    help='Build and reuse wheels through a wheelhouse shared by all '
+         'virtualenvs in the home folder.')
+@click.option(
+    '--wheelhouse-size', envvar='PIPSI_WHEELHOUSE_SIZE', default='1G',
+    show_default=True,
+    help='The size the wheelhouse is trimmed to after installs.')
+@click.option(
+    '--templates/--no-templates', envvar='PIPSI_TEMPLATES', default=True,
+    help='Create Python 3 virtualenvs by cloning a pristine template '
+         'virtualenv kept per interpreter.')
+@click.option(
+    '--dedupe/--no-dedupe', envvar='PIPSI_DEDUPE', default=False,
+    help='Hardlink identical files of new and upgraded virtualenvs to '
+         'the ones of other virtualenvs.')
+@click.option(
+    '--launchers/--no-launchers', envvar='PIPSI_LAUNCHERS', default=False,
+    help='Write small launchers for console_scripts entry points into the '
+         'bin folder instead of linking the scripts pip generated.')
+@click.option(
+    '--timings', is_flag=True, envvar='PIPSI_TIMINGS',
+    help='Print how long each phase took at the end.')
+@click.option(
+    '--trace', type=click.Path(dir_okay=False), envvar='PIPSI_TRACE',
+    help='Write a trace of all phases in the Chrome trace event format '
+         'to this file.')
 @click.version_option(
     message='%(prog)s, version %(version)s, python ' + str(sys.executable))
 @click.pass_context
-def cli(ctx, home, bin_dir):
+def cli(ctx, home, bin_dir, wheelhouse, wheelhouse_size, templates, dedupe,
+        launchers, timings, trace):
     """pipsi is a tool that uses virtualenv and pip to install shell
     tools that are separated from each other.
     """
-    ctx.obj = Repo(home, bin_dir)
+    tracer.enabled = bool(timings or trace)
+    if timings:
+        ctx.call_on_close(print_timings)
+    if trace:
+        ctx.call_on_close(lambda: tracer.write_chrome_trace(trace))
+    try:
+        wheelhouse_size = parse_size(wheelhouse_size)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--wheelhouse-size')
+    ctx.obj = Repo(home, bin_dir, wheelhouse, wheelhouse_size, templates,
+                   dedupe, launchers)
+
+
+def jobs_option(f):
+    return click.option(
+        '--jobs', '-j', type=click.IntRange(1, None), default=1,
+        envvar='PIPSI_JOBS', show_default=True,
+        help='How many packages to process in parallel.')(f)
 
 
 @cli.command()
-@click.argument('package')
+@click.argument('packages', nargs=-1, metavar='PACKAGE...')
 @click.option(
     '--python', type=str,
     envvar='PIPSI_PYTHON',
@@ -474,81 +3049,563 @@ def cli(ctx, home, bin_dir):
 @click.option('--system-site-packages', is_flag=True,
               help='Give the virtual environment access to the global '
                    'site-packages.')
+@click.option('--force', is_flag=True,
+              help='Replace scripts that belong to other packages.')
+@click.option('--slim', is_flag=True,
+              help='Remove files the package does not need to run, see '
+                   '`pipsi slim`.')
+@click.option('--from-bundle', 'bundles', type=click.File('rb'),
+              multiple=True,
+              help='Install from a bundle written by `pipsi bundle` instead '
+                   'of through pip.  Can be given more than once.')
+@jobs_option
 @click.pass_obj
-def install(repo, package, python, editable, system_site_packages):
-    """Installs scripts from a Python package.
+def install(repo, packages, python, editable, system_site_packages, force,
+            slim, bundles, jobs):
+    """Installs scripts from Python packages.
 
     Given a package this will install all the scripts and their dependencies
     of the given Python package into a new virtualenv and symlinks the
-    discovered scripts into BIN_DIR (defaults to ~/.local/bin).
+    discovered scripts into BIN_DIR (defaults to ~/.local/bin).  Multiple
+    packages are installed into separate virtualenvs, up to JOBS at a time.
     """
+    if bundles:
+        if packages:
+            raise click.UsageError('Cannot combine --from-bundle with '
+                                   'packages.')
+        if slim:
+            raise click.UsageError('Cannot combine --from-bundle with '
+                                   '--slim.  Slim packages before bundling '
+                                   'them instead.')
+        names = [click.format_filename(bundle.name) for bundle in bundles]
+        by_name = dict(zip(names, bundles))
+        return finish_batch(run_batch(
+            lambda name: repo.install_bundle(by_name[name], force),
+            names, jobs))
+    if not packages:
+        raise click.UsageError('Missing argument "PACKAGE...".')
     if re.search(r'^\d$', python):
         python = int(python)
-    if repo.install(package, python, editable, system_site_packages):
-        click.echo('Done.')
     else:
-        sys.exit(1)
+        try:
+            python = locate_python(python)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--python')
+    finish_batch(run_batch(
+        lambda package: repo.install(
+            package, python, editable, system_site_packages, force, slim),
+        packages, jobs))
 
 
 @cli.command()
-@click.argument('package')
+@click.argument('packages', nargs=-1, metavar='[PACKAGE]...')
+@click.option('--all', 'upgrade_all', is_flag=True,
+              help='Upgrade all outdated packages installed from an '
+                   'index.')
 @click.option('--editable', '-e', is_flag=True,
               help='Enable editable installation.  This only works for '
                    'locally installed packages.')
+@click.option('--force', is_flag=True,
+              help='Replace scripts that belong to other packages.')
+@jobs_option
 @click.pass_obj
-def upgrade(repo, package, editable):
-    """Upgrades an already installed package."""
-    if repo.upgrade(package, editable):
-        click.echo('Done.')
-    else:
+def upgrade(repo, packages, upgrade_all, editable, force, jobs):
+    """Upgrades already installed packages."""
+    if upgrade_all:
+        if packages:
+            raise click.UsageError('Cannot combine --all with packages.')
+        if editable:
+            raise click.UsageError('Cannot combine --all with --editable.')
+        return upgrade_everything(repo, force, jobs)
+    if not packages:
+        raise click.UsageError('Missing argument "PACKAGE...".')
+    finish_batch(run_batch(
+        lambda package: repo.upgrade(package, editable, force),
+        packages, jobs))
+
+
+def upgrade_everything(repo, force, jobs):
+    packages = list(repo.iter_packages())
+    if not packages:
+        click.echo('There are no packages installed through pipsi')
+        return
+
+    # Packages installed from a folder or URL, or editable ones, would be
+    # replaced with whatever the index has under their name.
+    skipped = dict((venv, info.get('source')) for venv, info in packages
+                   if info.get('editable') or
+                   not is_index_source(info.get('source')))
+    venvs = [venv for venv, _ in packages]
+    versions = {}
+    timings = dict((venv, 0) for venv in skipped)
+
+    def _check(venv):
+        start = time.time()
+        try:
+            venv_path = repo.get_package_path(venv)
+            versions[venv] = repo.get_installed_version(venv_path, venv)
+            return repo.get_up_to_date_version(venv_path, venv) is None
+        finally:
+            timings[venv] = time.time() - start
+
+    checked = [venv for venv in venvs if venv not in skipped]
+    click.echo('Checking %d packages for updates...' % len(checked))
+    check_results = run_batch(_check, checked, jobs)
+    outdated = [r.package for r in check_results if r.ok]
+    # a package whose check raised is neither up to date nor upgraded
+    check_failed = set(r.package for r in check_results if r.error)
+
+    def _upgrade(venv):
+        start = time.time()
+        try:
+            return repo.upgrade_from_index(venv, force, check=False)
+        finally:
+            timings[venv] += time.time() - start
+
+    results = dict((venv, None) for venv in venvs)
+    if outdated:
+        click.echo('Upgrading %d packages...' % len(outdated))
+        for result in run_batch(_upgrade, outdated, jobs):
+            results[result.package] = result.ok
+
+    click.echo()
+    width = max(len(venv) for venv in venvs)
+    for venv in venvs:
+        old = versions.get(venv) or 'unknown'
+        if venv in skipped:
+            change = 'skipped, installed from %s' % (
+                skipped[venv] or 'a folder')
+        elif venv in check_failed:
+            change = '%s (check failed)' % old
+        elif results[venv] is None:
+            change = '%s (up to date)' % old
+        elif results[venv]:
+            new = repo.get_installed_version(repo.get_package_path(venv), venv)
+            change = '%s -> %s' % (old, new or 'unknown')
+        else:
+            change = '%s (failed)' % old
+        click.echo('  %-*s  %-30s %6.1fs' % (width, venv, change,
+                                             timings[venv]))
+    if check_failed or False in results.values():
         sys.exit(1)
+    click.echo('Done.')
 
 
-@cli.command(short_help='Uninstalls scripts of a package.')
-@click.argument('package')
+@cli.command()
+@click.argument('packages', nargs=-1, metavar='[PACKAGE]...')
+@click.option('--all', 'reinstall_all', is_flag=True,
+              help='Reinstall all packages whose interpreter is gone or, '
+                   'with --python, has another version.')
+@click.option(
+    '--python', type=str, default=None,
+    help='The python interpreter to use, could be major version or path.  '
+         'Defaults to the one each package was installed with.')
+@click.option('--force', is_flag=True,
+              help='Replace scripts that belong to other packages.')
+@jobs_option
+@click.pass_obj
+def reinstall(repo, packages, reinstall_all, python, force, jobs):
+    """Builds the virtualenvs of installed packages again.
+
+    Packages are installed again from the spec they were installed with.
+    Each new virtualenv is built next to the old one, which keeps working
+    until the new one replaces it.  This is useful to move packages to a
+    new Python after the old one was upgraded or removed.
+    """
+    if python is not None:
+        try:
+            if re.search(r'^\d$', python):
+                python = repo.pythons.find(int(python))
+            else:
+                python = locate_python(python)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--python')
+    if reinstall_all:
+        if packages:
+            raise click.UsageError('Cannot combine --all with packages.')
+        version = None
+        if python is not None:
+            version = repo.pythons.probe(python)['version']
+        packages = repo.find_stale_virtualenvs(version)
+        if not packages:
+            click.echo('All virtualenvs have a working interpreter')
+            return
+        click.echo('Reinstalling %s...' % ', '.join(packages))
+    elif not packages:
+        raise click.UsageError('Missing argument "PACKAGE...".')
+    finish_batch(run_batch(
+        lambda package: repo.reinstall(package, python, force),
+        packages, jobs))
+
+
+@cli.command(short_help='Uninstalls scripts of packages.')
+@click.argument('packages', nargs=-1, required=True, metavar='PACKAGE...')
 @click.option('--yes', is_flag=True, help='Skips all prompts.')
+@jobs_option
 @click.pass_obj
-def uninstall(repo, package, yes):
-    """Uninstalls all scripts of a Python package and cleans up the
-    virtualenv.
+def uninstall(repo, packages, yes, jobs):
+    """Uninstalls all scripts of Python packages and cleans up their
+    virtualenvs.
     """
-    uinfo = repo.uninstall(package)
-    if not uinfo.installed:
-        click.echo('%s is not installed' % package)
-    else:
-        click.echo('The following paths will be removed:')
-        for path in uinfo.paths:
-            click.echo('  %s' % click.format_filename(path))
-        click.echo()
-        if yes or click.confirm('Do you want to uninstall %s?' % package):
-            uinfo.perform()
-            click.echo('Done!')
+    uinfos = {}
+    for package in packages:
+        uinfo = repo.uninstall(package)
+        if not uinfo.installed:
+            click.echo('%s is not installed' % package)
         else:
-            click.echo('Aborted!')
-            sys.exit(1)
+            uinfos[package] = uinfo
+    packages = [package for package in packages if package in uinfos]
+    if not packages:
+        return
+
+    click.echo('The following paths will be removed:')
+    for package in packages:
+        for path in uinfos[package].paths:
+            click.echo('  %s' % click.format_filename(path))
+    click.echo()
+    if not (yes or click.confirm(
+            'Do you want to uninstall %s?' % ', '.join(packages))):
+        click.echo('Aborted!')
+        sys.exit(1)
+
+    def _perform(package):
+        uinfos[package].perform()
+        return True
+
+    results = run_batch(_perform, packages, jobs)
+    finish_batch(results, done='Done!')
+
+
+@cli.command()
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the manifest to.  Defaults to stdout.')
+@click.pass_obj
+def freeze(repo, output):
+    """Writes a manifest of all installed packages.
+
+    The manifest can be used with `pipsi sync` to install the same packages
+    on another machine.
+    """
+    json.dump({'packages': repo.freeze()}, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+@cli.command()
+@click.argument('manifest', type=click.File('r'))
+@click.option('--yes', is_flag=True, help='Skips all prompts.')
+@jobs_option
+@click.pass_obj
+def sync(repo, manifest, yes, jobs):
+    """Installs, upgrades and uninstalls packages to match a manifest
+    written by `pipsi freeze`.
+    """
+    try:
+        entries = json.load(manifest)['packages']
+    except (ValueError, KeyError, TypeError):
+        raise click.BadParameter('not a pipsi manifest',
+                                 param_hint='MANIFEST')
+    plan = repo.plan_sync(entries)
+    if not plan:
+        click.echo('Everything is in sync.')
+        return
+
+    click.echo('The following changes will be made:')
+    for action, name, entry in plan:
+        click.echo('  %-9s %s' % (action, entry['spec'] if entry else name))
+    click.echo()
+    if not (yes or click.confirm('Do you want to continue?')):
+        click.echo('Aborted!')
+        sys.exit(1)
+
+    actions = dict((name, (action, entry)) for action, name, entry in plan)
+
+    def _apply(name):
+        action, entry = actions[name]
+        if action in ('uninstall', 'replace'):
+            uinfo = repo.uninstall(name)
+            if uinfo.installed:
+                uinfo.perform()
+            if action == 'uninstall':
+                return True
+        if action == 'upgrade':
+            return repo.upgrade(entry['spec'], entry.get('editable'),
+                                check=False)
+        python = entry.get('python')
+        if python and not os.path.isfile(python):
+            python = None
+        return repo.install(entry['spec'], python, entry.get('editable'))
+
+    finish_batch(run_batch(_apply, [name for _, name, _ in plan], jobs))
+
+
+@cli.command()
+@click.argument('package')
+@click.option('--output', '-o', type=click.File('wb'), required=True,
+              help='The file to write the bundle to, - for stdout.')
+@click.pass_obj
+def bundle(repo, package, output):
+    """Exports an installed package as a bundle.
+
+    The bundle contains the virtualenv of the package and can be installed
+    with `pipsi install --from-bundle` on machines that have the same
+    Python version at the same place, without running pip.
+    """
+    rv = repo.bundle(package, output)
+    if not rv:
+        sys.exit(1)
+    click.echo('Bundled %s into %s' % (
+        package, click.format_filename(output.name)), err=True)
+
+
+@cli.command('compile')
+@click.argument('packages', nargs=-1, metavar='[PACKAGE]...')
+@click.option('--all', 'compile_all', is_flag=True,
+              help='Compile all installed packages.')
+@click.option('--optimize', '-O', type=click.IntRange(0, 2), multiple=True,
+              help='Compile for this optimization level.  Can be given '
+                   'more than once.  Defaults to the levels PYTHONOPTIMIZE '
+                   'asks for.')
+@click.pass_obj
+def compile_command(repo, packages, compile_all, optimize):
+    """Byte-compiles the virtualenvs of packages.
+
+    Only files whose source changed since they were last compiled are
+    compiled again.  This is useful after editing packages installed with
+    --editable or before making the home folder read-only.
+    """
+    if compile_all:
+        if packages:
+            raise click.UsageError('Cannot combine --all with packages.')
+        packages = [venv for venv, _ in repo.list_everything()]
+        if not packages:
+            click.echo('There are no packages installed through pipsi')
+            return
+    elif not packages:
+        raise click.UsageError('Missing argument "PACKAGE...".')
+
+    def _compile(package):
+        rv = repo.compile(package, optimize or None)
+        if rv is False:
+            echo('Some files of %s could not be compiled' % package)
+        return rv is not None
+
+    finish_batch(run_batch(_compile, packages, 1))
+
+
+@cli.command()
+@click.argument('packages', nargs=-1, metavar='[PACKAGE]...')
+@click.option('--all', 'slim_all', is_flag=True,
+              help='Slim all installed packages.')
+@click.option('--strip', 'classes', type=click.Choice(SLIM_CLASSES),
+              multiple=True,
+              help='Remove this class of files.  Can be given more than '
+                   'once.  Defaults to %s.' % ', '.join(DEFAULT_SLIM_CLASSES))
+@jobs_option
+@click.pass_obj
+def slim(repo, packages, slim_all, classes, jobs):
+    """Removes files packages do not need to run from their virtualenvs.
+
+    These are test suites (tests), documentation and examples (docs), C
+    headers (headers), bytecode of other interpreters or without source
+    (bytecode), pip and wheel (pip) and, only if asked for, setuptools
+    (setuptools).  pip and setuptools are kept if a package depends on
+    them.  pip is installed again when a package is upgraded, after which
+    the same files are removed again.
+    """
+    if slim_all:
+        if packages:
+            raise click.UsageError('Cannot combine --all with packages.')
+        packages = [venv for venv, _ in repo.list_everything()]
+        if not packages:
+            click.echo('There are no packages installed through pipsi')
+            return
+    elif not packages:
+        raise click.UsageError('Missing argument "PACKAGE...".')
+
+    def _slim(package):
+        rv = repo.slim(package, classes or None)
+        if rv is None:
+            return False
+        echo('Removed %d files (%s) from %s' % (
+            rv[0], format_size(rv[1]), package))
+        return True
+
+    finish_batch(run_batch(_slim, packages, jobs))
 
 
 @cli.command('list')
 @click.option('--versions', is_flag=True,
               help='Show packages version')
+@click.option('--json', 'output_format', flag_value='json',
+              help='Print the packages as a JSON array.')
+@click.option('--ndjson', 'output_format', flag_value='ndjson',
+              help='Print every package as a JSON object on its own line.')
+@click.option('--package', '-p', 'package_patterns', multiple=True,
+              metavar='GLOB', help='Only list packages matching this glob.  '
+                                   'Can be given more than once.')
+@click.option('--script', '-s', 'script_patterns', multiple=True,
+              metavar='GLOB', help='Only list packages with a script '
+                                   'matching this glob.  Can be given more '
+                                   'than once.')
 @click.pass_obj
-def list_cmd(repo, versions):
-    """Lists all scripts installed through pipsi."""
-    list_of_non_empty_venv = [(venv, scripts)
-                              for venv, scripts in repo.list_everything()
-                              if scripts]
-    if list_of_non_empty_venv:
-        click.echo('Packages and scripts installed through pipsi:')
-        for venv, (scripts, version) in repo.list_everything(versions):
-            if versions:
-                click.echo('  Package "%s" (%s):' % (venv, version or 'unknown'))
-            else:
-                click.echo('  Package "%s":' % venv)
-                for script in scripts:
-                    click.echo('    ' + script)
-    else:
+def list_cmd(repo, versions, output_format, package_patterns,
+             script_patterns):
+    """Lists all scripts installed through pipsi.
+
+    Packages are printed as soon as they are read.  The JSON formats
+    include the version, scripts, interpreter and source of every package.
+    """
+    packages = repo.iter_packages(package_patterns, script_patterns)
+    if output_format in ('json', 'ndjson'):
+        first = True
+        for venv, info in packages:
+            line = json.dumps({
+                'name': venv,
+                'path': repo.get_package_path(venv),
+                'version': info.get('version'),
+                'scripts': info.get('scripts', []),
+                'python': info.get('python'),
+                'source': info.get('source'),
+                'editable': bool(info.get('editable')),
+                'installed_at': info.get('installed_at'),
+            }, sort_keys=True)
+            if output_format == 'json':
+                line = ('[' if first else ',') + line
+            click.echo(line)
+            first = False
+        if output_format == 'json':
+            click.echo('[]' if first else ']')
+        return
+
+    found = False
+    for venv, info in packages:
+        if not found:
+            click.echo('Packages and scripts installed through pipsi:')
+            found = True
+        if versions:
+            click.echo('  Package "%s" (%s):' % (
+                venv, info.get('version') or 'unknown'))
+        else:
+            click.echo('  Package "%s":' % venv)
+            for script in info.get('scripts', []):
+                click.echo('    ' + script)
+    if not found:
         click.echo('There are no scripts installed through pipsi')
 
 
+@cli.command()
+@click.argument('script')
+@click.pass_obj
+def which(repo, script):
+    """Shows which package a script belongs to."""
+    name = os.path.basename(script)
+    owner = repo.load_owners().get(name)
+    if owner is None:
+        click.echo('%s was not installed through pipsi' % name, err=True)
+        sys.exit(1)
+    target = real_readlink(join(repo.bin_dir, name))
+    click.echo('%s belongs to package "%s" in %s' % (
+        name, owner, click.format_filename(join(repo.home, owner))))
+    if target is not None:
+        click.echo('  -> %s' % click.format_filename(target))
+
+
+@cli.command()
+@click.pass_obj
+def reindex(repo):
+    """Rebuilds the package index from the virtualenvs."""
+    packages = repo.reindex()
+    click.echo('Indexed %d packages.' % len(packages))
+
+
+@cli.command()
+@click.option('--refresh', is_flag=True,
+              help='Probe all known interpreters again.')
+@click.pass_obj
+def pythons(repo, refresh):
+    """Lists the Python interpreters known to pipsi."""
+    if refresh:
+        for python in repo.pythons.refresh():
+            click.echo('Forgot about %s' % click.format_filename(python))
+    known = repo.pythons.known()
+    if not known:
+        click.echo('There are no known Python interpreters')
+    for info in known:
+        line = '  %s (%s)' % (click.format_filename(info['python']),
+                              '.'.join(map(str, info['version'])))
+        if info['real_prefix']:
+            line += ' based on %s' % click.format_filename(info['real_python'])
+        click.echo(line)
+
+
+@cli.command()
+@click.pass_obj
+def dedupe(repo):
+    """Hardlinks identical files of all virtualenvs.
+
+    Files in the site-packages of every virtualenv are hashed and identical
+    ones are replaced by hardlinks to a single copy kept in the home
+    folder.  Files that did not change since the last run are skipped.
+    """
+    linked, saved, freed = repo.dedupe()
+    click.echo('Hardlinked %d files, saved %s.' % (linked, format_size(saved)))
+    if freed:
+        click.echo('Removed %s of unused shared files.' % format_size(freed))
+
+
+@cli.command()
+@click.pass_obj
+def gc(repo):
+    """Removes leftovers of uninstalled packages.
+
+    This deletes uninstalled virtualenvs that were not yet deleted in the
+    background, links in the bin folder that point to virtualenvs which
+    no longer exist and virtualenvs of installs that crashed.
+    """
+    removed, freed = repo.gc()
+    for path in removed:
+        click.echo('  Removed %s' % click.format_filename(path))
+    click.echo('Removed %d paths.' % len(removed))
+    if freed:
+        click.echo('Removed %s of unused shared files.' % format_size(freed))
+
+
+@cli.group()
+def cache():
+    """Inspects and prunes the shared wheelhouse."""
+
+
+@cache.command('list')
+@click.pass_obj
+def cache_list(repo):
+    """Lists the cached wheels, least recently used first."""
+    wheels = repo.wheelhouse.wheels()
+    for name, size, last_used in wheels:
+        click.echo('  %s  %10s  %s' % (
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)),
+            format_size(size), name))
+    click.echo('%d wheels, %s in %s' % (
+        len(wheels), format_size(sum(size for _, size, _ in wheels)),
+        click.format_filename(repo.wheelhouse.path)))
+
+
+@cache.command('prune')
+@click.option('--max-size', default=None,
+              help='Trim the wheelhouse to this size instead of the '
+                   'configured one.  Use 0 to remove all wheels.')
+@click.pass_obj
+def cache_prune(repo, max_size):
+    """Removes the least recently used wheels."""
+    if max_size is not None:
+        try:
+            max_size = parse_size(max_size)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--max-size')
+    removed = repo.wheelhouse.prune(max_size)
+    for name, size in removed:
+        click.echo('  Removed %s' % name)
+    click.echo('Freed %s.' % format_size(sum(size for _, size in removed)))
+
+
 if __name__ == '__main__':
     cli()
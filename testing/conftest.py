@@ -14,3 +14,40 @@ def bin(tmpdir, mix):
 @pytest.fixture
 def home(tmpdir, mix):
     return tmpdir.ensure(mix, 'venvs', dir=1)
+
+
+@pytest.fixture
+def make_venv(home):
+    """Creates a fake virtualenv in the home folder that has a package
+    installed as far as its metadata is concerned.  A `runnable` one uses
+    the interpreter running the tests.
+    """
+    import os
+    import sys
+    from pipsi import IS_WIN, BIN_DIR
+
+    def make_venv(name, version='1.0', scripts=(), runnable=False):
+        venv = home.ensure(name.lower(), dir=True)
+        python = venv.join(BIN_DIR, 'python.exe' if IS_WIN else 'python')
+        if runnable:
+            venv.join('pyvenv.cfg').write(
+                'home = %s\n' % os.path.dirname(sys.executable))
+            python.dirpath().ensure(dir=True)
+            python.mksymlinkto(sys.executable)
+        else:
+            python.ensure()
+        if IS_WIN:
+            site_packages = venv.ensure('Lib', 'site-packages', dir=True)
+        else:
+            site_packages = venv.ensure(
+                'lib', 'python%d.%d' % sys.version_info[:2],
+                'site-packages', dir=True)
+        dist = site_packages.ensure('%s-%s.dist-info' % (name, version),
+                                    dir=True)
+        dist.join('METADATA').write(
+            'Name: %s\nVersion: %s\n\n' % (name, version))
+        for script in scripts:
+            venv.ensure(BIN_DIR, script).chmod(0o755)
+        return venv
+
+    return make_venv
@@ -10,3 +10,190 @@ def test_list_command(home):
         'pipsi', '--home', home.strpath, 'list'
     ])
     assert output.strip() == b'There are no scripts installed through pipsi'
+
+
+def test_import_is_lazy():
+    # Importing these takes a good part of the startup time of `pipsi list`
+    heavy = ['pkg_resources', 'distutils', 'subprocess', 'glob', 'shutil',
+             'tempfile', 'hashlib']
+    output = subprocess.check_output([sys.executable, '-c', (
+        'import sys, pipsi; '
+        'print(" ".join(m for m in %r if m in sys.modules))' % (heavy,))])
+    assert output.strip() == b''
+
+
+# A generous budget for `pipsi list` to start, list and exit, far above
+# what it takes without heavy imports but low enough to catch regressions
+# like importing pkg_resources again.
+LIST_BUDGET = 2.0
+
+
+def test_list_starts_fast(home, bin, make_venv):
+    import time
+    from pipsi import Repo
+
+    venv = make_venv('foo')
+    Repo(home.strpath, bin.strpath).save_package_info(
+        venv.strpath, 'foo', [('x', bin.join('foo').strpath)])
+    args = ['--home', home.strpath, '--bin-dir', bin.strpath, 'list']
+    heavy = ['pkg_resources', 'distutils', 'subprocess', 'glob', 'shutil',
+             'tempfile', 'hashlib']
+    output = subprocess.check_output([sys.executable, '-c', (
+        'import sys\n'
+        'from pipsi import cli\n'
+        'try:\n'
+        '    cli(%r, prog_name="pipsi")\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'print("heavy: " + " ".join(m for m in %r if m in sys.modules))' % (
+            args, heavy))])
+    assert b'Package "foo"' in output
+    assert output.splitlines()[-1].strip() == b'heavy:'
+
+    timings = []
+    for _ in range(3):
+        start = time.time()
+        subprocess.check_output([sys.executable, '-m', 'pipsi'] + args)
+        timings.append(time.time() - start)
+    assert min(timings) < LIST_BUDGET
+
+
+def test_install_many_reports_failures(home, bin, tmpdir):
+    from click.testing import CliRunner
+    from pipsi import cli
+
+    missing = [str(tmpdir.ensure(name, dir=True)) for name in ('one', 'two')]
+    result = CliRunner().invoke(cli, [
+        '--home', home.strpath, '--bin-dir', bin.strpath,
+        'install', '--jobs', '2'] + missing)
+    assert result.exit_code == 1
+    assert 'Summary:' in result.output
+    assert '%s: failed' % missing[0] in result.output
+    assert 'does not appear to be a local Python package' in result.output
+
+
+def test_install_unknown_python(home, bin):
+    from click.testing import CliRunner
+    from pipsi import cli
+
+    result = CliRunner().invoke(cli, [
+        '--home', home.strpath, '--bin-dir', bin.strpath,
+        'install', '--python', 'nopython3.99', 'foo'])
+    assert result.exit_code == 2
+    assert 'Can not find nopython3.99 in PATH' in result.output
+
+
+def test_reinstall_unknown_python(home, bin, monkeypatch):
+    from click.testing import CliRunner
+    from pipsi import cli
+
+    monkeypatch.setenv('PATH', bin.strpath)
+    runner = CliRunner()
+    args = ['--home', home.strpath, '--bin-dir', bin.strpath, 'reinstall',
+            '--all', '--python']
+    for python in ('9', 'python9.99'):
+        result = runner.invoke(cli, args + [python])
+        assert result.exit_code == 2, result.output
+        assert 'Can not find python9' in result.output
+
+
+def test_which_command(home, bin):
+    from click.testing import CliRunner
+    from pipsi import cli, Repo
+
+    Repo(home.strpath, bin.strpath)._update_index(
+        lambda packages: packages.update(foo={'scripts': [
+            bin.join('foo-tool').strpath]}))
+    runner = CliRunner()
+    args = ['--home', home.strpath, '--bin-dir', bin.strpath, 'which']
+    result = runner.invoke(cli, args + ['foo-tool'])
+    assert result.exit_code == 0
+    assert 'belongs to package "foo"' in result.output
+    assert runner.invoke(cli, args + ['other']).exit_code == 1
+
+
+def test_list_json(home, bin, make_venv):
+    import json
+    from click.testing import CliRunner
+    from pipsi import cli, Repo
+
+    repo = Repo(home.strpath, bin.strpath)
+    for name in ('foo', 'bar'):
+        venv = make_venv(name)
+        repo.save_package_info(str(venv), name,
+                               [('x', bin.join(name + '-tool').strpath)])
+    runner = CliRunner()
+    args = ['--home', home.strpath, '--bin-dir', bin.strpath, 'list']
+
+    result = runner.invoke(cli, args + ['--json'])
+    assert result.exit_code == 0, result.output
+    packages = json.loads(result.output)
+    assert [p['name'] for p in packages] == ['bar', 'foo']
+    assert packages[1]['scripts'] == [bin.join('foo-tool').strpath]
+    assert packages[1]['path'] == home.join('foo').strpath
+
+    result = runner.invoke(cli, args + ['--ndjson', '--script', 'foo-*'])
+    assert [json.loads(line)['name']
+            for line in result.output.splitlines()] == ['foo']
+    result = runner.invoke(cli, args + ['--json', '--package', 'baz'])
+    assert json.loads(result.output) == []
+
+    result = runner.invoke(cli, args + ['--package', 'b*'])
+    assert 'Package "bar"' in result.output
+    assert 'foo' not in result.output
+
+
+def test_upgrade_all_only_upgrades_outdated(home, bin, make_venv,
+                                            monkeypatch):
+    from click.testing import CliRunner
+    from pipsi import cli, Repo
+
+    repo = Repo(home.strpath, bin.strpath)
+    for name in ('current', 'outdated', 'local'):
+        make_venv(name)
+    # a folder of the same name in the working directory is no package
+    monkeypatch.chdir(home)
+    repo.save_package_info(home.join('local').strpath, 'local', [],
+                           source=home.join('src').strpath)
+    monkeypatch.setattr(
+        Repo, 'get_up_to_date_version',
+        lambda self, venv_path, spec: None if spec != 'current' else '1.0')
+    upgraded = []
+
+    def upgrade(self, venv, force=False, check=True):
+        assert not check
+        upgraded.append(venv)
+        return True
+    monkeypatch.setattr(Repo, 'upgrade_from_index', upgrade)
+
+    result = CliRunner().invoke(cli, [
+        '--home', home.strpath, '--bin-dir', bin.strpath,
+        'upgrade', '--all', '--jobs', '2'])
+    assert result.exit_code == 0, result.output
+    assert upgraded == ['outdated']
+    assert '1.0 (up to date)' in result.output
+    assert '1.0 -> 1.0' in result.output
+    assert 'skipped, installed from %s' % home.join('src') in result.output
+
+
+def test_upgrade_all_reports_failed_checks(home, bin, make_venv,
+                                           monkeypatch):
+    from click.testing import CliRunner
+    from pipsi import cli, Repo
+
+    for name in ('current', 'broken'):
+        make_venv(name)
+
+    def up_to_date_version(self, venv_path, spec):
+        if spec == 'broken':
+            raise RuntimeError('index unreachable')
+        return '1.0'
+    monkeypatch.setattr(Repo, 'get_up_to_date_version', up_to_date_version)
+
+    result = CliRunner().invoke(cli, [
+        '--home', home.strpath, '--bin-dir', bin.strpath,
+        'upgrade', '--all'])
+    assert result.exit_code == 1, result.output
+    assert 'Error: index unreachable' in result.output
+    assert '1.0 (check failed)' in result.output
+    assert '1.0 (up to date)' in result.output
@@ -1,6 +1,7 @@
 import os.path
 import sys
 import subprocess
+import pytest
 from pipsi import IS_WIN
 
 
@@ -15,3 +16,23 @@ def test_create_env(tmpdir):
     pipsi_bin = str(tmpdir.join('test_bin/pipsi' + ('.exe' if IS_WIN else '')))
 
     subprocess.check_call([pipsi_bin])
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='the zipapp is built with Python 3.7+')
+def test_install_zipapp(tmpdir):
+    pyz = str(tmpdir.join('pipsi.pyz'))
+    subprocess.check_call([sys.executable, 'build-zipapp.py', '-o', pyz])
+    subprocess.check_call([
+        sys.executable, 'get-pipsi.py',
+        '--home', str(tmpdir.join('venv')),
+        '--bin-dir', str(tmpdir.join('test_bin')),
+        '--zipapp', pyz,
+        '--ignore-existing',
+        '--no-modify-path',
+    ])
+    pipsi_bin = str(tmpdir.join('test_bin/pipsi' + ('.pyz' if IS_WIN else '')))
+
+    output = subprocess.check_output([
+        sys.executable, pipsi_bin, '--home', str(tmpdir.join('venv')), 'list'])
+    assert output.strip() == b'There are no scripts installed through pipsi'
@@ -1,8 +1,10 @@
+import json
 import os
 import sys
+import py
 import pytest
 import click
-from pipsi import Repo, find_scripts
+from pipsi import Repo, find_scripts, IS_WIN
 
 
 @pytest.fixture
@@ -25,6 +27,47 @@ def test_resolve_local_package(repo, tmpdir):
     assert repo.resolve_package(str(pkgdir)) == ('foopkg', [str(pkgdir)])
 
 
+@pytest.mark.resolve
+def test_resolve_local_package_statically(repo, tmpdir):
+    pkgdir = tmpdir.ensure('foopkg', dir=True)
+    pkgdir.join('setup.py').write('raise Exception("not run")')
+    pkgdir.join('setup.cfg').write('[metadata]\nname = cfgpkg\n')
+    assert repo.resolve_package(str(pkgdir)) == ('cfgpkg', [str(pkgdir)])
+
+    pkgdir.join('pyproject.toml').write('\n'.join([
+        '[build-system]',
+        'requires = ["flit_core"]',
+        'name = "not-this"',
+        '',
+        '[project]',
+        "name = 'tomlpkg'  # the name",
+        'version = "1.0"',
+    ]))
+    assert repo.resolve_package(str(pkgdir)) == ('tomlpkg', [str(pkgdir)])
+
+    pkgdir.join('setup.py').remove()
+    assert repo.resolve_package(str(pkgdir)) == ('tomlpkg', [str(pkgdir)])
+
+
+@pytest.mark.resolve
+def test_resolve_local_package_caches_setup_py(repo, tmpdir, monkeypatch):
+    import pipsi
+    pkgdir = tmpdir.ensure('foopkg', dir=True)
+    pkgdir.join('setup.py').write('from setuptools import setup\n'
+                                  'setup(name="foopkg")\n')
+    pkgdir.join('setup.cfg').write('[metadata]\nname = attr: foo.NAME\n')
+    assert repo.resolve_package(str(pkgdir)) == ('foopkg', [str(pkgdir)])
+
+    monkeypatch.setattr(pipsi, 'run', None)
+    assert repo.resolve_package(str(pkgdir)) == ('foopkg', [str(pkgdir)])
+
+    # changes to the build files invalidate the cache
+    monkeypatch.undo()
+    pkgdir.join('setup.py').write('from setuptools import setup\n'
+                                  'setup(name="barpkg")\n')
+    assert repo.resolve_package(str(pkgdir)) == ('barpkg', [str(pkgdir)])
+
+
 @pytest.mark.resolve
 def test_resolve_local_fails_when_invalid_package(repo, tmpdir):
     pkgdir = tmpdir.ensure('foopkg', dir=True)
@@ -85,3 +128,794 @@ def test_find_scripts():
     scripts = list(find_scripts(env, 'pipsi'))
     print('scripts %r' % scripts)
     assert scripts
+
+
+def test_run_batch_keeps_going_on_failure(capsys):
+    from pipsi import run_batch, echo
+
+    def work(package):
+        echo('working on %s' % package)
+        if package == 'bad':
+            raise ValueError('broken package')
+        return True
+
+    results = run_batch(work, ['good', 'bad', 'other'], jobs=2)
+    assert [(r.package, r.ok) for r in results] == [
+        ('good', True), ('bad', False), ('other', True)]
+    out = capsys.readouterr().out
+    assert '[good] working on good' in out
+    assert '[bad] Error: broken package' in out
+
+
+def test_call_streams_output_into_buffer(tmpdir):
+    import sys
+    from pipsi import call, _output, _LogBuffer
+
+    # the command only finishes once its first line has been seen
+    flag = tmpdir.join('seen')
+    script = (
+        'import os, sys, time\n'
+        'print("first"); sys.stdout.flush()\n'
+        'deadline = time.time() + 10\n'
+        'while not os.path.exists(%r) and time.time() < deadline:\n'
+        '    time.sleep(0.05)\n'
+        'print("second" if os.path.exists(%r) else "timed out")\n'
+    ) % (str(flag), str(flag))
+    _output.buffer = _LogBuffer(lambda line: flag.ensure())
+    try:
+        assert call([sys.executable, '-c', script]) == 0
+        assert _output.buffer == ['first', 'second']
+    finally:
+        _output.buffer = None
+
+
+def test_wheelhouse_evicts_least_recently_used(tmpdir):
+    from pipsi import Wheelhouse
+
+    wheelhouse = Wheelhouse(str(tmpdir.ensure('wheelhouse', dir=True)),
+                            max_size=150)
+    for name in ('old-1.0-py3-none-any.whl', 'new-1.0-py3-none-any.whl'):
+        build = tmpdir.ensure('build-' + name, dir=True)
+        build.join(name).write('x' * 100)
+        wheelhouse.add(str(build))
+
+    assert [name for name, _, _ in wheelhouse.wheels()] == [
+        'old-1.0-py3-none-any.whl', 'new-1.0-py3-none-any.whl']
+    assert wheelhouse.prune() == [('old-1.0-py3-none-any.whl', 100)]
+    assert [name for name, _, _ in wheelhouse.wheels()] == [
+        'new-1.0-py3-none-any.whl']
+
+
+def test_parse_size():
+    from pipsi import parse_size
+    assert parse_size('0') == 0
+    assert parse_size('10K') == 10 * 1024
+    assert parse_size('2G') == 2 * 1024 ** 3
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+
+@pytest.mark.parametrize('value, name', [
+    ('grin', 'grin'),
+    ('Flask_Login[extra]>=1.0', 'Flask-Login'),
+    ('zope.interface == 5', 'zope.interface'),
+    ('foo; python_version < "3"', 'foo'),
+])
+def test_requirement_name(value, name):
+    from pipsi import requirement_name
+    assert requirement_name(value) == name
+
+
+def test_requirement_name_invalid():
+    from pipsi import requirement_name
+    with pytest.raises(ValueError):
+        requirement_name('>=1.0')
+
+
+@pytest.mark.skipif(sys.version_info[0] != 3 or IS_WIN,
+                    reason='templates are used for Python 3 venvs only')
+def test_create_virtualenv_from_template(repo, home):
+    from pipsi import get_python_semver, get_real_python, TEMPLATE_INFO
+
+    semver = get_python_semver(sys.executable)
+    venv_path = home.join('cloned')
+    assert repo.create_virtualenv(str(venv_path), sys.executable, semver)
+    pip = venv_path.join('bin', 'pip').read()
+    assert pip.startswith('#!' + str(venv_path))
+    assert not venv_path.join(TEMPLATE_INFO).check()
+
+    template = repo.get_template(get_real_python(sys.executable), semver)
+    info = json.loads(py.path.local(template).join(TEMPLATE_INFO).read())
+    info['stamp'] = [0, 0]
+    py.path.local(template).join(TEMPLATE_INFO).write(json.dumps(info))
+    assert repo.get_template(get_real_python(sys.executable), semver) is None
+
+
+def test_dedupe_hardlinks_identical_files(repo, home):
+    from pipsi import UninstallInfo
+
+    for venv in ('one', 'two'):
+        home.ensure(venv, 'lib', 'site-packages', 'mod.py').write('x' * 100)
+        home.ensure(venv, 'lib', 'site-packages', venv + '.py').write(venv)
+    one = home.join('one', 'lib', 'site-packages', 'mod.py')
+    two = home.join('two', 'lib', 'site-packages', 'mod.py')
+
+    assert repo.dedupe() == (1, 100, 0)
+    assert os.path.samefile(str(one), str(two))
+    # Unchanged files are neither hashed nor linked again
+    assert repo.dedupe() == (0, 0, 0)
+
+    UninstallInfo('one', [str(home.join('one'))]).perform()
+    assert two.read() == 'x' * 100
+    assert repo.dedupe() == (0, 0, 3)
+    UninstallInfo('two', [str(home.join('two'))]).perform()
+    assert repo.dedupe() == (0, 0, 103)
+
+
+def test_find_scripts_reads_metadata_without_python(tmpdir):
+    from pipsi import extract_package_version, normalize
+    venv = tmpdir.ensure('venv', dir=True)
+    bin_dir = venv.ensure('Scripts' if IS_WIN else 'bin', dir=True)
+    if IS_WIN:
+        site_packages = venv.ensure('Lib', 'site-packages', dir=True)
+        record_prefix = '../Scripts/'
+    else:
+        site_packages = venv.ensure('lib', 'python3.6', 'site-packages',
+                                    dir=True)
+        record_prefix = '../../../bin/'
+    dist = site_packages.ensure('Foo_Bar-1.2.dist-info', dir=True)
+    dist.join('METADATA').write('Metadata-Version: 2.1\nName: Foo-Bar\n'
+                                'Version: 1.2\n\nVersion: 0\n')
+    dist.join('RECORD').write('\n'.join([
+        'foo_bar.py,sha256=abc,10',
+        '"%sfoo-bar,x",sha256=abc,10' % record_prefix,
+        '%sfoobar,sha256=abc,10' % record_prefix,
+    ]))
+    for name in ('foo-bar,x', 'foobar'):
+        script = bin_dir.join(name)
+        script.write('#!/bin/sh\n')
+        script.chmod(0o755)
+
+    # there is no python in the virtualenv, so this can only succeed
+    # by reading the metadata directly
+    assert sorted(find_scripts(str(venv), 'foo.bar')) == [
+        normalize(str(bin_dir.join('foo-bar,x'))),
+        normalize(str(bin_dir.join('foobar'))),
+    ]
+    assert extract_package_version(str(venv), 'foo-bar') == '1.2'
+
+    # requirements with versions and extras are found the same way
+    assert len(find_scripts(str(venv), 'foo.bar[x]>=1.0')) == 2
+    assert extract_package_version(str(venv), 'Foo_Bar==1.2') == '1.2'
+
+
+@pytest.mark.skipif(IS_WIN, reason='uses a shell script as interpreter')
+def test_python_registry_caches_probes(repo, tmpdir, monkeypatch):
+    import pipsi
+    python = tmpdir.join('python')
+    python.write('#!/bin/sh\nexec "%s" "$@"\n' % sys.executable)
+    python.chmod(0o755)
+
+    info = repo.pythons.probe(str(python))
+    assert tuple(info['version']) == sys.version_info[:3]
+
+    def fail(python):
+        raise AssertionError('interpreter was probed again')
+    monkeypatch.setattr(pipsi, 'get_python_semver', fail)
+    assert repo.pythons.probe(str(python)) == info
+    assert [i['python'] for i in repo.pythons.known()] == [
+        os.path.realpath(str(python))]
+
+    python.setmtime(python.mtime() - 100)
+    with pytest.raises(AssertionError):
+        repo.pythons.probe(str(python))
+
+
+@pytest.mark.skipif(IS_WIN, reason='uses a shell script as interpreter')
+def test_python_registry_looks_up_commands_in_path(repo, tmpdir,
+                                                   monkeypatch):
+    python = tmpdir.ensure('path', dir=True).join('mypython')
+    python.write('#!/bin/sh\nexec "%s" "$@"\n' % sys.executable)
+    python.chmod(0o755)
+    monkeypatch.setenv('PATH', python.dirname)
+    monkeypatch.chdir(tmpdir)
+
+    info = repo.pythons.probe('mypython')
+    assert info['python'] == os.path.realpath(str(python))
+    with pytest.raises(ValueError):
+        repo.pythons.probe('nopython')
+
+
+def test_package_index(repo, home, bin, make_venv):
+    foo = make_venv('foo')
+    bar = make_venv('bar', '2.0')
+    foo_script = str(bin.ensure('foo'))
+    bar_script = str(bin.ensure('bar'))
+    repo.save_package_info(str(foo), 'foo', [('x', foo_script)], 'python3')
+    repo.save_package_info(str(bar), 'bar', [('x', bar_script)], 'python3')
+
+    # the index is used instead of the package info of every virtualenv
+    foo.join('package_info.json').remove()
+    assert repo.list_everything(versions=True) == [
+        ('bar', [[bar_script], '2.0']),
+        ('foo', [[foo_script], '1.0']),
+    ]
+    assert repo.get_package_scripts(str(foo)) == [foo_script]
+    assert repo.load_index()['foo']['python'] == 'python3'
+
+    repo.uninstall('bar').perform()
+    assert sorted(repo.load_index()) == ['foo']
+    assert not bin.join('bar').check()
+
+    assert repo.reindex() == {'foo': {}}
+
+
+
+def test_iter_packages_filters(repo, home, bin, make_venv):
+    for name in ('foo', 'foobar', 'bar'):
+        make_venv(name)
+        repo.save_package_info(str(home.join(name)), name,
+                               [('x', str(bin.join(name + '-cli')))])
+    make_venv('broken')
+    home.join('broken', 'package_info.json').write('{')
+    os.remove(repo.index_path)
+
+    # without an index only the matching package infos are read
+    assert [venv for venv, info in repo.iter_packages(['FOO*'])] == \
+        ['foo', 'foobar']
+    assert not os.path.exists(repo.index_path)
+    assert [venv for venv, info in repo.iter_packages()] == \
+        ['bar', 'broken', 'foo', 'foobar']
+    assert os.path.exists(repo.index_path)
+
+    assert [venv for venv, info in repo.iter_packages(
+        scripts=['*bar-cli'])] == ['bar', 'foobar']
+    assert [venv for venv, info in repo.iter_packages(
+        ['foo*'], ['*bar-*'])] == ['foobar']
+    assert list(repo.iter_packages(['nothing'])) == []
+
+
+def test_batch_api_results(repo, home, bin, make_venv, monkeypatch, capsys):
+    from pipsi import Repo, echo
+
+    def install(self, spec, python=None, editable=False,
+                system_site_packages=False, force=False, slim=False):
+        echo('installing %s' % spec)
+        if spec == 'broken':
+            raise ValueError('cannot build')
+        name = spec.split('==')[0]
+        venv = make_venv(name)
+        self.save_package_info(str(venv), name,
+                               [('x', str(bin.ensure(name)))])
+        return True
+    monkeypatch.setattr(Repo, 'install', install)
+
+    events = []
+    results = repo.install_many(
+        ['foo==1.0', 'broken'], jobs=2,
+        progress=lambda event, result: events.append((event, result.spec)))
+    assert [r.status for r in results] == ['installed', 'failed']
+    foo, broken = results
+    assert foo.ok and foo.package == 'foo'
+    assert foo.version == '1.0'
+    assert foo.scripts == [str(bin.join('foo'))]
+    assert foo.log == ['installing foo==1.0']
+    assert foo.seconds >= 0
+    assert not broken.ok
+    assert str(broken.error) == 'cannot build'
+    assert broken.log[-1] == 'Error: cannot build'
+    assert sorted(events) == sorted([
+        ('started', 'foo==1.0'), ('output', 'foo==1.0'),
+        ('finished', 'foo==1.0'), ('started', 'broken'),
+        ('output', 'broken'), ('output', 'broken'), ('finished', 'broken')])
+    assert capsys.readouterr().out == ''
+
+    monkeypatch.setattr(Repo, 'upgrade', lambda self, spec, *args: True)
+    results = repo.upgrade_many(['foo', 'bar'])
+    assert [(r.package, r.status) for r in results] == [
+        ('foo', 'up-to-date'), ('bar', 'not-installed')]
+
+    results = repo.uninstall_many(['foo', 'bar'])
+    assert [(r.status, r.version) for r in results] == [
+        ('uninstalled', '1.0'), ('not-installed', None)]
+    assert results[0].to_dict()['ok']
+    assert not home.join('foo').check()
+
+
+def make_dist(site_packages, name, files, requires=()):
+    """Writes the given files and a dist-info with a RECORD for them."""
+    dist = site_packages.ensure('%s-1.0.dist-info' % name, dir=True)
+    dist.join('METADATA').write(''.join(
+        ['Name: %s\nVersion: 1.0\n' % name] +
+        ['Requires-Dist: %s\n' % req for req in requires]))
+    for path in files:
+        site_packages.ensure(*path.split('/')).write('x' * 10)
+    records = list(files) + ['%s-1.0.dist-info/METADATA' % name,
+                             '%s-1.0.dist-info/RECORD' % name]
+    dist.join('RECORD').write(''.join('%s,,\n' % f for f in records))
+    return dist
+
+
+@pytest.mark.skipif(IS_WIN, reason='different virtualenv layout')
+def test_slim(repo, home, bin, make_venv, monkeypatch):
+    import pipsi
+    from pipsi import find_site_packages
+    venv = make_venv('foo', scripts=['foo'])
+    site_packages = py.path.local(find_site_packages(str(venv))[0])
+    tag = 'cpython-%d%d' % sys.version_info[:2]
+    foo = make_dist(site_packages, 'foo', [
+        'foo/__init__.py', 'foo/core.py',
+        'foo/__pycache__/core.%s.pyc' % tag,
+        'foo/__pycache__/core.cpython-27.pyc',
+        'foo/__pycache__/gone.%s.pyc' % tag,
+        'foo/tests/__init__.py', 'foo/tests/test_core.py',
+        'foo/include/foo.h'])
+    pip = make_dist(site_packages, 'pip', ['pip/__init__.py',
+                                           '../../../bin/pip'])
+    repo.save_package_info(str(venv), 'foo',
+                           [('x', str(bin.ensure('foo')))])
+
+    assert repo.slim('missing') is None
+    count, freed = repo.slim('foo')
+    assert count == 9 and freed > 7 * 10
+    assert not pip.check() and not site_packages.join('pip').check()
+    assert not venv.join('bin', 'pip').check()
+    assert not site_packages.join('foo', 'tests').check()
+    assert sorted(line.split(',')[0] for line in
+                  foo.join('RECORD').read().splitlines()) == [
+        'foo-1.0.dist-info/METADATA', 'foo-1.0.dist-info/RECORD',
+        'foo/__init__.py', 'foo/__pycache__/core.%s.pyc' % tag,
+        'foo/core.py']
+    assert repo.get_package_info(str(venv))['slim'] == sorted(
+        pipsi.DEFAULT_SLIM_CLASSES)
+    assert repo.load_index()['foo']['slim']
+
+    # checking for a newer version does not need pip in the virtualenv
+    calls = []
+
+    def run(args):
+        from subprocess import CompletedProcess
+        calls.append(args)
+        return CompletedProcess(args, 0, 'Available versions: 1.0', '')
+    monkeypatch.setattr(pipsi, 'run', run)
+    monkeypatch.setattr(pipsi, 'call', lambda args: calls.append(args) or 0)
+    assert repo.available_versions(str(venv), 'foo') == ['1.0']
+    assert calls == [[sys.executable, '-m', 'pip', 'index', 'versions',
+                      '--python-version', '%d.%d' % sys.version_info[:2],
+                      'foo']]
+
+    # but pip is restored before it installs something
+    del calls[:]
+    assert repo._ensure_pip(str(venv))
+    assert calls[0][1:] == ['-m', 'ensurepip', '--default-pip']
+
+    # distributions something depends on are kept
+    bar = make_venv('bar')
+    site_packages = py.path.local(find_site_packages(str(bar))[0])
+    make_dist(site_packages, 'tool', ['tool.py'], requires=['pip (>=9)'])
+    make_dist(site_packages, 'pip', ['pip/__init__.py'])
+    assert pipsi.slim_virtualenv(str(bar), ['pip']) == (0, 0)
+    assert site_packages.join('pip', '__init__.py').check()
+
+
+@pytest.mark.skipif(IS_WIN, reason='different virtualenv layout')
+def test_slim_deduped(repo, home, make_venv):
+    from pipsi import find_site_packages, slim_virtualenv
+    dists = []
+    for name in ('a', 'b'):
+        venv = make_venv(name)
+        site_packages = py.path.local(find_site_packages(str(venv))[0])
+        dists.append(make_dist(site_packages, 'tool', [
+            'tool/__init__.py', 'tool/tests/test_x.py']))
+    repo.dedupe()
+    a, b = [dist.join('RECORD') for dist in dists]
+    assert os.path.samefile(str(a), str(b))
+
+    assert slim_virtualenv(str(home.join('a')), ['tests'])[0] == 1
+    assert 'tool/tests/test_x.py' not in a.read()
+    assert 'tool/tests/test_x.py' in b.read()
+    assert b.dirpath('..', 'tool', 'tests', 'test_x.py').check()
+
+@pytest.mark.skipif(IS_WIN, reason='scripts are copied on windows')
+def test_script_conflicts(repo, home, bin, make_venv):
+    from pipsi import BIN_DIR
+    foo = make_venv('foo', scripts=['tool'])
+    bar = make_venv('bar', scripts=['tool', 'bar'])
+    foo_tool = str(foo.join(BIN_DIR, 'tool'))
+    bar_tool = str(bar.join(BIN_DIR, 'tool'))
+    bar_bar = str(bar.join(BIN_DIR, 'bar'))
+
+    repo.save_package_info(str(foo), 'foo', repo.link_scripts([foo_tool]))
+    assert repo.load_owners() == {'tool': 'foo'}
+    assert repo.find_conflicts([bar_tool, bar_bar], str(bar)) == [
+        (bar_tool, 'foo')]
+    # relinking the own scripts is fine
+    assert repo.find_conflicts([foo_tool], str(foo)) == []
+
+    assert repo.link_scripts([bar_tool, bar_bar], str(bar)) == [
+        (bar_bar, str(bin.join('bar')))]
+    assert os.path.realpath(str(bin.join('tool'))) == foo_tool
+
+    linked = repo.link_scripts([bar_tool], str(bar), force=True)
+    repo.save_package_info(str(bar), 'bar', linked)
+    assert repo.load_owners() == {'tool': 'bar'}
+    assert repo.get_package_info(str(foo))['scripts'] == []
+
+    bin.ensure('unmanaged')
+    assert repo.find_conflicts(['/elsewhere/unmanaged'], str(foo)) == [
+        ('/elsewhere/unmanaged', None)]
+
+
+def test_up_to_date_version(repo, make_venv, monkeypatch):
+    venv = str(make_venv('foo', '1.0'))
+    available = ['0.9', '1.0']
+    monkeypatch.setattr(repo, 'available_versions', lambda *args: available)
+
+    assert repo.get_up_to_date_version(venv, 'foo') == '1.0'
+    assert repo.get_up_to_date_version(venv, 'foo>=1.1') is None
+    available.append('1.1')
+    assert repo.get_up_to_date_version(venv, 'foo') is None
+    assert repo.get_up_to_date_version(venv, 'foo<1.1') == '1.0'
+    available = None
+    assert repo.get_up_to_date_version(venv, 'foo') is None
+
+
+def test_file_lock(tmpdir):
+    import threading
+    from pipsi import FileLock
+
+    lock = FileLock(str(tmpdir.join('locks', 'foo.lock')))
+    other = []
+    with lock:
+        # reentrant within a thread, exclusive between threads
+        assert lock.acquire(blocking=False)
+        lock.release()
+        t = threading.Thread(target=lambda: other.append(
+            FileLock(lock.path).acquire(blocking=False)))
+        t.start()
+        t.join()
+    assert other == [False]
+    assert FileLock(lock.path).acquire(blocking=False)
+
+
+def test_package_locks_do_not_clash_with_internal_locks(repo):
+    import threading
+
+    other = []
+    with repo.package_lock('bin'):
+        t = threading.Thread(target=lambda: other.append(
+            repo.lock('bin').acquire(blocking=False)))
+        t.start()
+        t.join()
+    assert other == [True]
+
+
+def test_install_cleans_up_crashed_installs(repo, home, monkeypatch):
+    from pipsi import INCOMPLETE_MARKER
+    home.ensure('foo', INCOMPLETE_MARKER)
+    home.ensure('.staging', 'foo+abc', 'bin', 'python')
+    home.ensure('.staging', 'foo-bar+abc', 'bin', 'python')
+    monkeypatch.setattr(repo, 'create_virtualenv', lambda *args: False)
+
+    assert repo.install('foo') is False
+    assert not home.join('foo').check()
+    assert home.join('.staging').listdir() == [
+        home.join('.staging', 'foo-bar+abc')]
+
+
+@pytest.mark.skipif(IS_WIN, reason='scripts are copied on windows')
+def test_uninstall_moves_to_trash(repo, home, bin, make_venv):
+    import time
+    from pipsi import BIN_DIR
+    foo = make_venv('foo', scripts=['foo'])
+    repo.save_package_info(str(foo), 'foo', repo.link_scripts(
+        [str(foo.join(BIN_DIR, 'foo'))], str(foo)))
+
+    repo.uninstall('foo').perform()
+    assert not foo.check()
+    assert not bin.join('foo').check()
+    assert repo.load_index() == {}
+    # the trashed virtualenv is deleted by a background process
+    for _ in range(100):
+        if not home.join('.trash').listdir():
+            break
+        time.sleep(0.05)
+    assert home.join('.trash').listdir() == []
+
+
+@pytest.mark.skipif(IS_WIN, reason='scripts are copied on windows')
+def test_gc(repo, home, bin, make_venv):
+    import threading
+    from pipsi import BIN_DIR, INCOMPLETE_MARKER
+    trashed = repo.trash(str(make_venv('old')))
+    gone = make_venv('gone', scripts=['gone'])
+    repo.link_scripts([str(gone.join(BIN_DIR, 'gone'))])
+    gone.remove()
+    bin.join('unmanaged').mksymlinkto('/nonexistent/unmanaged')
+    make_venv('crashed').ensure(INCOMPLETE_MARKER)
+    home.ensure('.staging', 'crashed+abc', 'bin', 'python')
+    home.ensure('.staging', 'busy+abc', 'bin', 'python')
+    ok = make_venv('ok')
+    busy_trashed = repo.trash(str(make_venv('busy')))
+
+    # another thread is installing busy right now, and might still move
+    # its old virtualenv back out of the trash
+    locked, done = threading.Event(), threading.Event()
+
+    def install_busy():
+        with repo.package_lock('busy'):
+            locked.set()
+            done.wait()
+    t = threading.Thread(target=install_busy)
+    t.start()
+    locked.wait()
+    try:
+        removed, freed = repo.gc()
+    finally:
+        done.set()
+        t.join()
+    assert sorted(removed) == sorted([
+        trashed, str(bin.join('gone')), str(home.join('crashed')),
+        str(home.join('.staging', 'crashed+abc'))])
+    assert bin.join('unmanaged').check(link=True)
+    assert home.join('.staging', 'busy+abc').check()
+    assert os.path.isdir(busy_trashed)
+    assert ok.check()
+    assert repo.gc() == ([busy_trashed,
+                          str(home.join('.staging', 'busy+abc'))], 0)
+
+
+@pytest.mark.skipif(IS_WIN or sys.version_info < (3, 4),
+                    reason='launchers are written for Python 3 on POSIX')
+def test_launchers(home, bin, make_venv):
+    import subprocess
+    from pipsi import BIN_DIR, find_site_packages
+    repo = Repo(str(home), str(bin), use_launchers=True)
+    venv = make_venv('foo', scripts=['foo', 'legacy'], runnable=True)
+    site_packages = py.path.local(find_site_packages(str(venv))[0])
+    site_packages.join('foo.py').write(
+        'import sys\n'
+        'def main():\n'
+        '    print("pkg_resources" in sys.modules, sys.flags.isolated)\n')
+    site_packages.join('foo-1.0.dist-info', 'entry_points.txt').write(
+        '[console_scripts]\nfoo = foo:main\n')
+
+    scripts = [str(venv.join(BIN_DIR, 'foo')),
+               str(venv.join(BIN_DIR, 'legacy'))]
+    assert len(repo.link_scripts(scripts, str(venv))) == 2
+    assert not bin.join('foo').check(link=True)
+    assert bin.join('legacy').check(link=True)
+    assert subprocess.check_output([str(bin.join('foo'))]) == b'False 1\n'
+
+    # launchers of removed virtualenvs are cleaned up by gc
+    assert repo.find_orphaned_scripts() == []
+    venv.remove()
+    assert repo.find_orphaned_scripts() == [
+        str(bin.join('foo')), str(bin.join('legacy'))]
+
+
+def test_make_launcher_long_path(tmpdir):
+    from pipsi import make_launcher, read_launcher_virtualenv
+    venv = str(tmpdir.join('x' * 150))
+    launcher = make_launcher(venv, 'foo.cli:main.run [extra]')
+    assert launcher.startswith('#!/bin/sh\n')
+    assert 'from foo.cli import main\n' in launcher
+    assert 'sys.exit(main.run())' in launcher
+    tmpdir.join('launcher').write(launcher)
+    assert read_launcher_virtualenv(str(tmpdir.join('launcher'))) == venv
+    assert make_launcher(venv, 'foo') is None
+
+
+@pytest.mark.skipif(IS_WIN or sys.version_info < (3, 5),
+                    reason='needs a runnable fake virtualenv')
+def test_compile(repo, make_venv, monkeypatch):
+    from pipsi import find_site_packages, get_virtualenv_python_version
+    venv = make_venv('foo', runnable=True)
+    assert get_virtualenv_python_version(str(venv)) == sys.version_info[:2]
+    site_packages = py.path.local(find_site_packages(str(venv))[0])
+    site_packages.join('foo.py').write('x = 1\n')
+
+    monkeypatch.delenv('PYTHONOPTIMIZE', raising=False)
+    assert repo.compile('foo') is True
+    cached = site_packages.join('__pycache__')
+    assert [p.basename.split('.')[-2] for p in cached.listdir()] == [
+        sys.implementation.cache_tag]
+
+    monkeypatch.setenv('PYTHONOPTIMIZE', '2')
+    assert repo.compile('foo') is True
+    assert len(cached.listdir()) == 2
+    assert cached.listdir('*.opt-2.pyc')
+
+    site_packages.join('broken.py').write('def\n')
+    assert repo.compile('foo', [0]) is False
+    assert repo.compile('bar') is None
+
+
+@pytest.mark.skipif(IS_WIN or sys.version_info < (3, 5),
+                    reason='needs a runnable fake virtualenv')
+def test_bundle(repo, home, bin, make_venv, tmpdir):
+    import io
+    from pipsi import BIN_DIR, find_site_packages
+    venv = make_venv('foo', scripts=['foo'], runnable=True)
+    venv.join(BIN_DIR, 'foo').write('#!%s/bin/python\n' % venv)
+    site_packages = py.path.local(find_site_packages(str(venv))[0])
+    site_packages.join('foo-1.0.dist-info', 'entry_points.txt').write(
+        '[console_scripts]\nfoo = foo:main\n')
+    repo.save_package_info(str(venv), 'foo', repo.link_scripts(
+        [str(venv.join(BIN_DIR, 'foo'))], str(venv)), source='foo')
+
+    buf = io.BytesIO()
+    assert repo.bundle('foo', buf)
+    assert repo.bundle('bar', io.BytesIO()) is None
+
+    other = Repo(str(tmpdir.join('other')), str(tmpdir.join('other-bin')))
+    buf.seek(0)
+    assert other.install_bundle(buf)
+    new_venv = tmpdir.join('other', 'foo')
+    assert new_venv.join(BIN_DIR, 'foo').read() == \
+        '#!%s/bin/python\n' % new_venv
+    assert os.path.realpath(str(tmpdir.join('other-bin', 'foo'))) == \
+        str(new_venv.join(BIN_DIR, 'foo'))
+    info = other.get_package_info(str(new_venv))
+    assert (info['version'], info['source']) == ('1.0', 'foo')
+    assert not tmpdir.join('other', '.staging').listdir()
+
+
+@pytest.mark.parametrize('members', [
+    [('venv/../evil', 'file', 'evil')],
+    # a file written through a symlink extracted before
+    [('venv/evil', 'symlink', 'OUTSIDE'), ('venv/evil', 'file', 'evil')],
+    [('venv/evil', 'symlink', 'OUTSIDE'), ('venv/evil/x', 'file', 'evil')],
+    # a hardlink to such a symlink
+    [('venv/evil', 'symlink', 'OUTSIDE'), ('venv/lnk', 'hardlink',
+                                           'venv/evil')],
+])
+def test_install_bundle_refuses_escaping_paths(repo, home, tmpdir, members):
+    import io
+    import tarfile
+    from pipsi import BUNDLE_INFO
+    outside = tmpdir.join('outside')
+    outside.write('safe')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, kind, data in [(BUNDLE_INFO, 'file', json.dumps({
+                'package': 'foo', 'path': '/somewhere/foo',
+                'python_version': [3, 0, 0], 'scripts': []}))] + members:
+            member = tarfile.TarInfo(name)
+            if kind == 'file':
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data.encode('utf-8')))
+                continue
+            member.type = tarfile.SYMTYPE if kind == 'symlink' \
+                else tarfile.LNKTYPE
+            member.linkname = str(outside) if data == 'OUTSIDE' else data
+            tar.addfile(member)
+    buf.seek(0)
+    with pytest.raises(ValueError):
+        repo.install_bundle(buf)
+    assert not tmpdir.join('evil').check()
+    assert outside.read() == 'safe'
+    assert not home.join('foo').check()
+
+
+@pytest.mark.skipif(IS_WIN, reason='scripts are copied on windows')
+def test_reinstall(repo, home, bin, make_venv, monkeypatch):
+    from pipsi import BIN_DIR
+    venv = make_venv('foo', scripts=['foo', 'old'])
+    venv.join(BIN_DIR, 'python').remove()
+    venv.join(BIN_DIR, 'python').mksymlinkto('/nonexistent/python')
+    repo.save_package_info(str(venv), 'foo', repo.link_scripts(
+        [str(venv.join(BIN_DIR, 'foo')), str(venv.join(BIN_DIR, 'old'))],
+        str(venv)), sys.executable, 'foo>=1')
+    make_venv('bar', runnable=True)
+    repo.reindex()
+    assert repo.find_stale_virtualenvs() == ['foo']
+    assert repo.find_stale_virtualenvs((2, 0)) == ['bar', 'foo']
+
+    built = []
+
+    def build(staging, install_args, *args):
+        built.append(install_args)
+        staging = py.path.local(staging)
+        dist = staging.ensure(
+            'lib', 'python%d.%d' % sys.version_info[:2], 'site-packages',
+            'foo-2.0.dist-info', dir=True)
+        dist.join('METADATA').write('Name: foo\nVersion: 2.0\n\n')
+        dist.join('entry_points.txt').write(
+            '[console_scripts]\nfoo = foo:main\n')
+        staging.ensure(BIN_DIR, 'foo').chmod(0o755)
+        staging.join(BIN_DIR, 'python').mksymlinkto(sys.executable)
+        return str(staging) if len(built) > 1 else None
+    monkeypatch.setattr(repo, '_build_virtualenv', build)
+
+    # a failed build keeps the old virtualenv
+    assert repo.reinstall('foo') is False
+    assert repo.get_installed_version(str(venv), 'foo') == '1.0'
+    assert bin.join('old').check(link=True)
+
+    assert repo.reinstall('foo') is True
+    assert built == [['foo>=1'], ['foo>=1']]
+    assert repo.get_installed_version(str(venv), 'foo') == '2.0'
+    assert repo.get_package_info(str(venv))['source'] == 'foo>=1'
+    assert not bin.join('old').check(link=True)
+    assert os.path.realpath(str(bin.join('foo'))) == \
+        str(venv.join(BIN_DIR, 'foo'))
+    assert repo.find_stale_virtualenvs() == []
+    assert not home.join('.staging').listdir()
+
+
+def test_freeze_and_plan_sync(repo, make_venv, tmpdir):
+    local = str(tmpdir.ensure('src', dir=True))
+    repo.save_package_info(str(make_venv('foo', '1.0')), 'foo', [],
+                           'python3', 'foo>=1', False)
+    repo.save_package_info(str(make_venv('bar', '2.0')), 'bar', [],
+                           'python3', local, True)
+    repo.save_package_info(str(make_venv('old')), 'old', [])
+
+    manifest = repo.freeze()
+    assert [(e['name'], e['spec'], e['editable']) for e in manifest] == [
+        ('bar', local, True), ('foo', 'foo==1.0', False),
+        ('old', 'old==1.0', False)]
+    assert repo.plan_sync(manifest) == []
+
+    manifest = [e for e in manifest if e['name'] != 'old']
+    manifest[1] = dict(manifest[1], version='1.1', spec='foo==1.1')
+    manifest.append({'name': 'new', 'spec': 'new'})
+    manifest[0] = dict(manifest[0], editable=False)
+    assert [(action, name) for action, name, _ in
+            repo.plan_sync(manifest)] == [
+        ('replace', 'bar'), ('upgrade', 'foo'), ('install', 'new'),
+        ('uninstall', 'old')]
+
+
+@pytest.mark.skipif(IS_WIN, reason='scripts are copied on windows')
+def test_upgrade_records_editable(repo, make_venv, monkeypatch):
+    import pipsi
+    from pipsi import BIN_DIR
+    venv = make_venv('foo', scripts=['foo'])
+    repo.save_package_info(str(venv), 'foo', [], editable=True)
+    monkeypatch.setattr(Repo, 'pip_install', lambda self, *args, **kw: True)
+    monkeypatch.setattr(pipsi, 'compile_virtualenv', lambda venv: True)
+    monkeypatch.setattr(pipsi, 'find_scripts', lambda venv, package: [
+        os.path.join(venv, BIN_DIR, 'foo')])
+
+    assert repo.upgrade('foo', check=False)
+    assert repo.get_package_info(str(venv))['editable'] is False
+
+
+def test_tracer(tmpdir):
+    from pipsi import Tracer
+    tracer = Tracer()
+    with tracer.span('outer', package='foo'):
+        with tracer.span('inner'):
+            pass
+        with tracer.span('inner'):
+            pass
+    assert sorted((name, count) for name, count, _ in tracer.summary()) == [
+        ('inner', 2), ('outer', 1)]
+
+    trace = tmpdir.join('trace.json')
+    tracer.write_chrome_trace(str(trace))
+    events = json.loads(trace.read())['traceEvents']
+    assert [e['name'] for e in events] == ['inner', 'inner', 'outer']
+    assert events[2]['ph'] == 'X'
+    assert events[2]['args'] == {'package': 'foo'}
+
+
+def test_tracing_is_off_by_default(repo, home, bin, tmpdir):
+    import pipsi
+    from click.testing import CliRunner
+    assert not pipsi.tracer.enabled
+    repo.list_everything()
+    assert pipsi.tracer.events == []
+
+    trace = tmpdir.join('trace.json')
+    try:
+        result = CliRunner().invoke(pipsi.cli, [
+            '--home', str(home), '--bin-dir', str(bin), '--trace', str(trace),
+            'list'])
+        assert pipsi.tracer.enabled
+    finally:
+        pipsi.tracer.enabled = False
+        del pipsi.tracer.events[:]
+    assert trace.check(), result.output